@@ -1,10 +1,29 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, jsonify
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
 
 events_bp = Blueprint('events_bp', __name__)
 
+# Service singleton, gán một lần khi blueprint được register
+_EVENT_SERVICE = None
+
+
+@events_bp.record_once
+def _bind_services(state):
+    global _EVENT_SERVICE
+    _EVENT_SERVICE = state.app.config['EVENT_SERVICE']
+
+
+MAX_EVENTS_LIMIT = 500
+
+def _clamp_limit(limit):
+    """Giới hạn limit trong [1, MAX_EVENTS_LIMIT] trước khi query Mongo"""
+    # Chỉ thiếu limit mới dùng mặc định; limit=0 / âm vẫn bị kẹp về 1
+    return 100 if limit is None else max(1, min(limit, MAX_EVENTS_LIMIT))
+
+
 @events_bp.route('/track', methods=['POST'])
 def track_event():
     """
@@ -32,7 +51,7 @@ def track_event():
         if not all([user_id, product_id, event_type]):
             return jsonify({"error": "user_id, product_id, và type là bắt buộc"}), 400
         
-        event_service = current_app.config['EVENT_SERVICE']
+        event_service = _EVENT_SERVICE
         event = event_service.track_event(user_id, product_id, event_type, metadata)
         
         return jsonify({
@@ -43,7 +62,7 @@ def track_event():
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logger.error(f"Error tracking event: {e}")
+        logger.error("Error tracking event: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -67,7 +86,7 @@ def batch_track_events():
         if not events or not isinstance(events, list):
             return jsonify({"error": "events phải là array"}), 400
         
-        event_service = current_app.config['EVENT_SERVICE']
+        event_service = _EVENT_SERVICE
         result = event_service.batch_track_events(events)
         
         return jsonify({
@@ -76,7 +95,7 @@ def batch_track_events():
         }), 201
         
     except Exception as e:
-        logger.error(f"Error batch tracking: {e}")
+        logger.error("Error batch tracking: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -87,13 +106,13 @@ def get_user_events(user_id):
     
     Query params:
         - type: Filter theo loại event (optional)
-        - limit: Số events (default: 100)
+        - limit: Số events (default: 100, tối đa 500)
     """
     try:
         event_type = request.args.get("type")
-        limit = request.args.get("limit", default=100, type=int)
+        limit = _clamp_limit(request.args.get("limit", default=100, type=int))
         
-        event_service = current_app.config['EVENT_SERVICE']
+        event_service = _EVENT_SERVICE
         events = event_service.get_user_events(user_id, event_type, limit)
         
         return jsonify({
@@ -103,21 +122,34 @@ def get_user_events(user_id):
         }), 200
         
     except Exception as e:
-        logger.error(f"Error getting user events: {e}")
+        logger.error("Error getting user events: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
 @events_bp.route('/user/<user_id>/stats', methods=['GET'])
 def get_user_stats(user_id):
-    """Thống kê events của user"""
+    """
+    Thống kê events của user
+    
+    Hỗ trợ conditional GET: ETag sinh từ timestamp event mới nhất,
+    trả 304 khi If-None-Match khớp (bỏ qua aggregation).
+    """
     try:
-        event_service = current_app.config['EVENT_SERVICE']
-        stats = event_service.get_user_stats(user_id)
+        event_service = _EVENT_SERVICE
+        latest_ts = event_service.get_user_latest_event_ts(user_id)
+        etag = hashlib.md5(f"{user_id}:{latest_ts}".encode()).hexdigest()
+        
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(event_service.get_user_stats(user_id))
         
-        return jsonify(stats), 200
+        response.set_etag(etag, weak=True)
+        response.cache_control.max_age = 5
+        return response
         
     except Exception as e:
-        logger.error(f"Error getting user stats: {e}")
+        logger.error("Error getting user stats: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -126,9 +158,9 @@ def get_product_events(product_id):
     """Lấy events của một product"""
     try:
         event_type = request.args.get("type")
-        limit = request.args.get("limit", default=100, type=int)
+        limit = _clamp_limit(request.args.get("limit", default=100, type=int))
         
-        event_service = current_app.config['EVENT_SERVICE']
+        event_service = _EVENT_SERVICE
         events = event_service.get_product_events(product_id, event_type, limit)
         
         return jsonify({
@@ -138,5 +170,5 @@ def get_product_events(product_id):
         }), 200
         
     except Exception as e:
-        logger.error(f"Error getting product events: {e}")
+        logger.error("Error getting product events: %s", e)
         return jsonify({"error": str(e)}), 500
\ No newline at end of file
@@ -1,13 +1,45 @@
-from flask import Blueprint, jsonify, current_app
+from flask import Blueprint, Response, current_app
 from datetime import datetime
+import time
+import orjson
+import pymongo
 
 health_bp = Blueprint("health_bp", __name__)
 
+# (giây monotonic, JSON body đã serialize) - chỉ build lại body mỗi giây
+_body_cache = (None, b"")
+
+# (monotonic deadline, kết quả ping) - tránh probe dày đặc dồn tải lên Mongo
+_PING_TTL = 2.0
+_ping_cache = (0.0, False)
+
+def _mongo_alive():
+    """Ping Mongo (lệnh 'ping' gần như không tốn chi phí server), cache kết quả ~2s."""
+    global _ping_cache
+    now = time.monotonic()
+    if now < _ping_cache[0]:
+        return _ping_cache[1]
+
+    svc = current_app.config.get("MONGODB_SERVICE")
+    ok = False
+    if svc is not None:
+        try:
+            with pymongo.timeout(0.2):
+                ok = bool(svc.db.command("ping").get("ok"))
+        except Exception:
+            ok = False
+    _ping_cache = (now + _PING_TTL, ok)
+    return ok
+
 @health_bp.route("/health", methods=["GET"])
 def health_check():
-    return jsonify({
-        "status": "healthy",
-        "mongodb": hasattr(current_app, "mongo_client"),
-        "vertex_ai": hasattr(current_app, "embedding_model"),
-        "timestamp": datetime.now().isoformat()
-    })
+    global _body_cache
+    sec = int(time.monotonic())
+    if _body_cache[0] != sec:
+        _body_cache = (sec, orjson.dumps({
+            "status": "healthy",
+            "mongodb": _mongo_alive(),
+            "vertex_ai": "VERTEX_AI_SERVICE" in current_app.config,
+            "timestamp": datetime.now().isoformat()
+        }))
+    return Response(_body_cache[1], mimetype="application/json")
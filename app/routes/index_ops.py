@@ -1,103 +1,150 @@
 # app/routes/index_ops.py
-from flask import Blueprint, jsonify, current_app
+from flask import Blueprint, jsonify
 from datetime import datetime
-import logging, time
+import logging
+from bson import ObjectId
+from pymongo import UpdateOne
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+try:
+    from itertools import batched
+except ImportError:  # Python < 3.12
+    def batched(iterable, n):
+        it = iter(iterable)
+        while chunk := tuple(islice(it, n)):
+            yield chunk
+from ..services.rate_limit import TokenBucket
 
 index_bp = Blueprint("index_bp", __name__)
 logger = logging.getLogger(__name__)
 
+# Service singletons, gán một lần khi blueprint được register
+_VERTEX = None
+_MONGO = None
+_EMB_QPM = 75  # số request embedding / phút (quota Vertex)
+
+
+@index_bp.record_once
+def _bind_services(state):
+    global _VERTEX, _MONGO, _EMB_QPM
+    _VERTEX = state.app.config.get("VERTEX_AI_SERVICE")
+    _MONGO = state.app.config.get("MONGODB_SERVICE")
+    _EMB_QPM = state.app.config.get("VERTEX_EMB_QPM", _EMB_QPM)
+
 def _vs():
-    svc = current_app.config.get("VERTEX_AI_SERVICE")
-    if not svc:
+    if not _VERTEX:
         raise RuntimeError("VERTEX_AI_SERVICE chưa được khởi tạo")
-    return svc
-
-def _chunks(items, n):
-    for i in range(0, len(items), n):
-        yield items[i:i+n]
+    return _VERTEX
+
+def _iter_product_texts(cursor):
+    """Yield (product_id, text) trực tiếp từ cursor - không giữ toàn bộ catalog trong RAM."""
+    for p in cursor:
+        name = p.get("name") or ""
+        desc = p.get("description") or ""
+        # cắt ngắn còn 4000 ký tự để giảm chi phí (1 lần nối + 1 slice)
+        text = (name + ". " + desc)[:4000] if desc else name[:4000]
+        _id = p["_id"]
+        yield (_id.binary.hex() if isinstance(_id, ObjectId) else str(_id)), text
+
+def _write_batch(vs, embeddings_col, failed_ids, now, ids, texts, future):
+    """Chờ embedding của một batch rồi upsert Mongo + Vertex. Trả về số vector đã upsert."""
+    try:
+        embs = future.result()
+    except Exception as ge:
+        # 429 đã được retry (exponential backoff + jitter) trong service
+        logger.warning("Batch embedding failed (%d items): %s", len(texts), ge)
+        # giữ embedding cũ của batch này, tiếp tục batch sau
+        failed_ids.extend(ids)
+        return 0
+
+    ops = []
+    pairs_for_upsert = []
+    # Vertex trả thiếu embedding so với input -> phần thiếu cũng coi như lỗi
+    failed_ids.extend(ids[len(embs):])
+    for pid, emb, txt in zip(ids, embs, texts):
+        if not emb:
+            # embedding rỗng (lỗi tạm thời): giữ vector cũ, không để stale sweep xoá
+            failed_ids.append(pid)
+            continue
+        ops.append(UpdateOne(
+            {"product_id": pid},
+            {"$set": {"embedding": emb, "text": txt, "updated_at": now},
+             "$setOnInsert": {"created_at": now}},
+            upsert=True,
+        ))
+        pairs_for_upsert.append((pid, emb))
+
+    if ops:
+        embeddings_col.bulk_write(ops, ordered=False)
+
+    if not pairs_for_upsert:
+        return 0
+    try:
+        vs.upsert_vectors(pairs_for_upsert)
+        logger.info("Upserted %d/%d this batch", len(pairs_for_upsert), len(ids))
+        return len(pairs_for_upsert)
+    except Exception as ve:
+        logger.error("Failed to upsert to Vertex VS (batch): %s", ve)
+        return 0
 
 @index_bp.route("/rebuild-index", methods=["POST"])
 def rebuild_index():
     try:
-        mongo = current_app.config["MONGODB_SERVICE"]
+        mongo = _MONGO
         products_col = mongo.db["products"]
         embeddings_col = mongo.db["product_embeddings"]
 
-        # (Nếu muốn clean full) Lấy old_ids TRƯỚC khi xoá Mongo
-        try:
-            old_ids = [doc.get("product_id") for doc in embeddings_col.find({}, {"product_id": 1})]
-            old_ids = [pid for pid in old_ids if pid]
-        except Exception as ve:
-            logger.warning("List old ids failed: %s", ve)
-            old_ids = []
-
-        # Xoá embeddings cũ ở Mongo
-        embeddings_col.delete_many({})
-
-        # Xoá vector cũ ở Vertex VS (nếu cần)
-        if old_ids:
-            try:
-                _vs().remove_vectors(old_ids)
-                logger.info("Removed %d old vectors from Vertex VS", len(old_ids))
-            except Exception as ve:
-                logger.warning("Could not remove old vectors from VS: %s", ve)
-
-        # Chuẩn bị dữ liệu cần embed
-        to_embed = []
-        for p in products_col.find({}, {"_id":1, "name":1, "description":1}):
-            pid = str(p["_id"])
-            name = p.get("name", "")
-            desc = p.get("description", "")
-            text = f"{name}. {desc}"
-            # (tuỳ) cắt ngắn để giảm chi phí
-            if len(text) > 4000:
-                text = text[:4000]
-            to_embed.append((pid, text))
+        # Upsert theo product_id: embeddings cũ vẫn query được trong lúc rebuild.
+        # Dùng 1 timestamp cho cả lần rebuild (updated_at của mọi doc được ghi)
+        # (BSON lưu datetime tới millisecond -> làm tròn để so sánh khớp với giá trị đã lưu)
+        rebuild_start = datetime.now()
+        rebuild_start = rebuild_start.replace(microsecond=rebuild_start.microsecond // 1000 * 1000)
+        failed_ids = []
 
         batch_size = 100   # tuỳ quota
         total_upsert = 0
-
-        for batch in _chunks(to_embed, batch_size):
-            ids = [pid for pid, _ in batch]
-            texts = [txt for _, txt in batch]
-
-            # Embedding batch (đã có retry/backoff bên trong service)
+        vs = _vs()
+
+        # rate-limit theo quota embeddings/phút, chỉ chờ khi thực sự vượt nhịp
+        bucket = TokenBucket(rate=_EMB_QPM / 60.0, capacity=1)
+
+        # Stream products theo batch từ cursor, embed ngay khi đọc xong mỗi batch
+        cursor = products_col.find(
+            {}, {"_id": 1, "name": 1, "description": 1}, batch_size=batch_size
+        )
+
+        # Pipeline: embedding batch k+1 chạy trong lúc ghi Mongo + Vertex cho batch k
+        # (tối đa 2 batch in-flight để giữ backpressure với quota Vertex)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            pending = None
+            for batch in batched(_iter_product_texts(cursor), batch_size):
+                ids, texts = zip(*batch)
+                bucket.acquire()
+                # Embedding batch (đã có retry/backoff bên trong service)
+                future = pool.submit(vs.create_embeddings_batch, texts, task_type="RETRIEVAL_DOCUMENT")
+                if pending:
+                    total_upsert += _write_batch(vs, embeddings_col, failed_ids, rebuild_start, *pending)
+                pending = (ids, texts, future)
+
+            if pending:
+                total_upsert += _write_batch(vs, embeddings_col, failed_ids, rebuild_start, *pending)
+
+        # Chỉ xoá embeddings không được cập nhật trong lần rebuild này (product đã bị xoá)
+        stale_filter = {"updated_at": {"$not": {"$gte": rebuild_start}}}
+        if failed_ids:
+            stale_filter["product_id"] = {"$nin": failed_ids}
+        stale_ids = [
+            doc["product_id"]
+            for doc in embeddings_col.find(stale_filter, {"product_id": 1, "_id": 0})
+            if doc.get("product_id")
+        ]
+        if stale_ids:
             try:
-                embs = _vs().create_embeddings_batch(texts, task_type="RETRIEVAL_DOCUMENT")
-            except Exception as ge:
-                logger.warning("Batch embedding failed (%d items): %s", len(texts), ge)
-                # nếu fail cả batch, tiếp tục batch sau
-                time.sleep(1.2)
-                continue
-
-            now = datetime.now()
-            docs = []
-            pairs_for_upsert = []
-            for pid, emb, txt in zip(ids, embs, texts):
-                if not emb:
-                    continue
-                docs.append({
-                    "product_id": pid,
-                    "embedding": emb,
-                    "text": txt,
-                    "created_at": now,
-                })
-                pairs_for_upsert.append((pid, emb))
-
-            if docs:
-                embeddings_col.insert_many(docs, ordered=False)
-
-            if pairs_for_upsert:
-                try:
-                    _vs().upsert_vectors(pairs_for_upsert)
-                    total_upsert += len(pairs_for_upsert)
-                    logger.info("Upserted %d/%d this batch, total=%d",
-                                len(pairs_for_upsert), len(batch), total_upsert)
-                except Exception as ve:
-                    logger.error("Failed to upsert to Vertex VS (batch): %s", ve)
-
-            # rate-limit nhẹ giữa các batch để tránh 429
-            time.sleep(0.8)
+                vs.remove_vectors(stale_ids)
+                logger.info("Removed %d stale vectors from Vertex VS", len(stale_ids))
+            except Exception as ve:
+                logger.warning("Could not remove stale vectors from VS: %s", ve)
+        embeddings_col.delete_many(stale_filter)
 
         return jsonify({"success": True, "rebuilt_count": total_upsert}), 200
 
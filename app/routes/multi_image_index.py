@@ -1,209 +1,677 @@
-from flask import Blueprint, current_app, jsonify
-from datetime import datetime
+from flask import Blueprint, jsonify, request
+from datetime import datetime, timedelta
 import logging
-import time
+import threading
+import uuid
+import base64
+import hashlib
+import heapq
+from collections import deque
+from itertools import islice
+from operator import itemgetter
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from bson import ObjectId
+from bson.binary import Binary
+from pymongo.write_concern import WriteConcern
+from ..services.rate_limit import TokenBucket
 
 multi_image_index_bp = Blueprint("multi_image_index_bp", __name__)
 logger = logging.getLogger(__name__)
 
+# Service singletons, gán một lần khi blueprint được register
+_VERTEX = None
+_MONGO = None
+_IMAGE_DISTANCE_MEASURE = ""
+
+
+@multi_image_index_bp.record_once
+def _bind_services(state):
+    global _VERTEX, _MONGO, _IMAGE_DISTANCE_MEASURE
+    _VERTEX = state.app.config.get("VERTEX_AI_SERVICE")
+    _MONGO = state.app.config.get("MONGODB_SERVICE")
+    _IMAGE_DISTANCE_MEASURE = state.app.config.get("IMAGE_INDEX_DISTANCE_MEASURE") or ""
+
 def _vs():
-    svc = current_app.config.get("VERTEX_AI_SERVICE")
-    if not svc:
+    if not _VERTEX:
         raise RuntimeError("VERTEX_AI_SERVICE chưa được khởi tạo")
-    return svc
+    return _VERTEX
+
+def _mongo():
+    if not _MONGO:
+        raise RuntimeError("MONGODB_SERVICE chưa được khởi tạo")
+    return _MONGO
 
 def _chunks(items, n):
-    for i in range(0, len(items), n):
-        yield items[i:i+n]
+    """Chia list hoặc iterator bất kỳ (cursor, generator) thành các list <= n phần tử"""
+    it = iter(items)
+    while chunk := list(islice(it, n)):
+        yield chunk
+
+# Index COSINE_DISTANCE: rerank tối đa N product có ANN distance tốt nhất; bỏ product mà ước lượng ANN
+# đã thấp hơn min_similarity quá biên độ (tránh Mongo + cosine cho ứng viên chắc chắn bị lọc)
+_RERANK_MAX_PRODUCTS = 100
+_ANN_PREFILTER_EPS = 0.05
+_NEIGHBOR_ORDER = itemgetter(1, 0)  # (distance, datapoint_id)
+
+def _ann_similarity(dist):
+    """
+    ANN distance -> similarity [0..1] cùng thang với rerank ((cos + 1) / 2).
+
+    Chỉ suy được khi image index dùng COSINE_DISTANCE (distance = 1 - cos, trong [0..2]).
+    Measure khác (DOT_PRODUCT_DISTANCE, SQUARED_L2_DISTANCE trên vector chưa chuẩn hoá)
+    hoặc chưa cấu hình -> None: caller không được lọc/chấm điểm bằng ANN distance.
+    """
+    if _IMAGE_DISTANCE_MEASURE != "COSINE_DISTANCE":
+        return None
+    return 1.0 - dist / 2.0
+
+# Bỏ field nội bộ nặng (text dùng để embedding) khi trả product về client
+_RESULT_PRODUCT_PROJECTION = {"text_indexed": 0}
+
+def _to_vector(emb):
+    """Embedding lưu dạng Binary float32 (mới) hoặc list float (cũ) -> np.ndarray float32"""
+    if isinstance(emb, bytes):  # bson Binary là subclass của bytes
+        return np.frombuffer(emb, dtype=np.float32)
+    return np.asarray(emb, dtype=np.float32)
+
+def _unit_vector(emb):
+    """float32 đã chuẩn hoá L2 (vector 0 giữ nguyên)"""
+    v = np.asarray(emb, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n else v
+
+# Tải ảnh song song (I/O-bound), rate limit chỉ áp dụng cho lời gọi embedding
+_DOWNLOAD_WORKERS = 16
+
+# Session dùng chung: keep-alive theo host CDN, tránh TCP + TLS handshake cho mỗi ảnh
+_HTTP = requests.Session()
+_HTTP.headers["User-Agent"] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+)
+_HTTP.mount("http://", _adapter)
+_HTTP.mount("https://", _adapter)
+
+# Quota multimodalembedding@001: 10 requests/minute, dùng 8 cho an toàn
+_IMAGE_EMB_RPM = 8
+
+# Số ảnh gửi trong 1 predict request embedding
+_EMBED_BATCH_SIZE = 4
+
+# Gom write ops của nhiều batch, flush theo lô lớn
+_WRITE_FLUSH_SIZE = 1000
+
+def _flush_bulk(col, ops):
+    """bulk_write unordered (thứ tự ghi không quan trọng)"""
+    try:
+        col.bulk_write(ops, ordered=False)
+    except Exception as me:
+        logger.error("MongoDB bulk write failed: %s", me)
 
+def _upsert_image_vectors(vs, pairs):
+    """Upsert 1 lô vector lên Vertex, trả về số vector đã upsert (chạy ở writer thread)"""
+    try:
+        vs.upsert_image_vectors(pairs)
+        logger.info("Upserted %d image vectors", len(pairs))
+        return len(pairs)
+    except Exception as ve:
+        logger.error("Failed to upsert image vectors: %s", ve)
+        return 0
+
+def _sync_image_batch(vs, items, now):
+    """
+    Upsert 1 lô lên Vertex rồi dựng write ops Mongo cho lô đó (chạy ở writer thread).
 
-@multi_image_index_bp.route("/rebuild-image-index-multi", methods=["POST"])
-def rebuild_image_index_multi():
+    vertex_synced ghi theo kết quả upsert: rebuild incremental chỉ bỏ qua datapoint
+    đã lên Vertex, lô upsert lỗi sẽ được embed (cache hit) + upsert lại ở lần sau.
+    Trả về (số vector đã upsert, ops).
+    """
+    upserted = _upsert_image_vectors(vs, [(item["datapoint_id"], item["embedding"]) for item in items])
+    ops = [
+        UpdateOne(
+            {"datapoint_id": item["datapoint_id"]},
+            {"$set": {
+                "product_id": item["product_id"],
+                # float32 packed, đã L2-normalize: search chỉ cần 1 phép dot
+                "embedding": Binary(_unit_vector(item["embedding"]).tobytes()),
+                "embedding_dim": len(item["embedding"]),
+                "normalized": True,
+                "model": vs.image_model_name,
+                "image_url": item["image_url"],
+                "position": item["position"],
+                "product_name": item["product_name"],
+                "vertex_synced": upserted > 0,
+                "updated_at": now,
+            },
+             "$setOnInsert": {"created_at": now}},
+            upsert=True,
+        )
+        for item in items
+    ]
+    return upserted, ops
+
+def _iter_product_images(cursor):
+    """Yield từng ảnh hợp lệ của products (url http/https) dưới dạng item dict"""
+    for p in cursor:
+        pid = str(p["_id"])
+        name = p.get("name", "")
+        for img in p.get("images") or ():
+            if isinstance(img, dict):
+                url = img.get("url")
+                position = img.get("position", 999)
+            elif isinstance(img, str):
+                url = img
+                position = 999
+            else:
+                continue
+
+            if not url or not isinstance(url, str):
+                continue
+
+            if not url.startswith(_URL_SCHEMES):
+                continue
+
+            yield {
+                "datapoint_id": f"{pid}_{position}",
+                "product_id": pid,
+                "image_url": url,
+                "position": position,
+                "product_name": name
+            }
+
+def _fan_out(batch_embeddings, items, emb):
+    """1 embedding dùng chung cho mọi datapoint trỏ tới cùng ảnh"""
+    for item in items:
+        batch_embeddings.append({
+            "datapoint_id": item["datapoint_id"],
+            "product_id": item["product_id"],
+            "embedding": emb,
+            "image_url": item["image_url"],
+            "position": item["position"],
+            "product_name": item["product_name"]
+        })
+
+_MAX_IMAGE_BYTES = 10 * 1024 * 1024  # 10MB
+_URL_SCHEMES = ("http://", "https://")
+
+def _download_image(url):
+    """
+    Tải 1 ảnh, trả về (bytes, None) hoặc (None, lý do lỗi)
+
+    Stream body và bỏ sớm khi header/số byte đã đọc vượt giới hạn hoặc không phải ảnh,
+    tránh tải trọn 10MB cho URL hỏng.
+    """
+    try:
+        with _HTTP.get(url, timeout=(5, 15), stream=True) as response:
+            if response.status_code != 200:
+                return None, f"HTTP {response.status_code}"
+
+            ctype = response.headers.get("Content-Type", "").lower()
+            if ctype and not ctype.startswith(("image/", "application/octet-stream")):
+                return None, f"not an image ({ctype})"
+
+            declared = response.headers.get("Content-Length", "")
+            if declared.isdigit() and int(declared) > _MAX_IMAGE_BYTES:
+                return None, f"too large ({declared} bytes)"
+
+            buf = bytearray()
+            for chunk in response.iter_content(chunk_size=65536):
+                buf += chunk
+                if len(buf) > _MAX_IMAGE_BYTES:
+                    return None, f"too large (> {_MAX_IMAGE_BYTES} bytes)"
+            return bytes(buf), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _run_image_rebuild(force=False):
     """
     Index TẤT CẢ hình ảnh của mỗi product
     
     Mỗi ảnh sẽ có datapoint_id riêng: "{product_id}_{position}"
     
     Rate limit: 10 requests/minute cho multimodalembedding@001
+
+    Incremental: datapoint đã có embedding cùng image_url + model thì bỏ qua (không tải,
+    không embed, không ghi lại Mongo/Vertex). force=True -> embed lại toàn bộ.
     """
+    # Resolve service 1 lần cho cả vòng rebuild
+    vs = _vs()
+    mongo = _mongo()
+    products_col = mongo.db["products"]
+    image_embeddings_col = mongo.db["product_image_embeddings"]
+
+    # Upsert theo datapoint_id cần index unique: dọn doc trùng từ các lần rebuild cũ rồi tạo
+    # index (migration xoá dữ liệu, chạy ở đây vì rebuild đã giữ job lock, không chạy lúc khởi động)
     try:
-        mongo = current_app.config["MONGODB_SERVICE"]
-        products_col = mongo.db["products"]
-        image_embeddings_col = mongo.db["product_image_embeddings"]
-
-        # Xóa embeddings cũ
-        try:
-            old_ids = [doc.get("datapoint_id") for doc in image_embeddings_col.find({}, {"datapoint_id": 1})]
-            old_ids = [did for did in old_ids if did]
-        except Exception as e:
-            logger.warning("List old image ids failed: %s", e)
-            old_ids = []
-
-        image_embeddings_col.delete_many({})
+        mongo.migrate_image_datapoint_index()
+    except Exception as e:
+        logger.warning("Could not migrate image datapoint index: %s", e)
+
+    # Upsert theo datapoint_id (không drop/xoá trước): embeddings cũ vẫn phục vụ search
+    # trong lúc rebuild, chạy lại giữa chừng không mất dữ liệu. Datapoint không còn trong
+    # catalog được dọn ở cuối.
+
+    # Stream ảnh từ cursor products, gom thẳng theo URL (không dựng list to_embed trung gian):
+    # ảnh dùng chung giữa nhiều product chỉ tải + embed 1 lần, kết quả fan-out cho mọi
+    # datapoint trỏ tới URL đó
+    # {datapoint_id: image_url} đã index bằng model hiện tại VÀ đã upsert lên Vertex
+    # (doc ghi trước khi có vertex_synced bị embed lại 1 lần, phần lớn là cache hit)
+    indexed = {} if force else {
+        doc["datapoint_id"]: doc.get("image_url")
+        for doc in image_embeddings_col.find(
+            {"model": vs.image_model_name, "vertex_synced": True},
+            {"datapoint_id": 1, "image_url": 1, "_id": 0},
+        ).batch_size(1000)
+    }
+
+    cursor = products_col.find({}, {"_id": 1, "name": 1, "images": 1}, batch_size=500)
+    url_groups = {}
+    seen_datapoints = set()
+    total_images = 0
+    unchanged_count = 0
+    for item in _iter_product_images(cursor):
+        if item["datapoint_id"] in seen_datapoints:
+            continue
+        seen_datapoints.add(item["datapoint_id"])
+        total_images += 1
+        if indexed.get(item["datapoint_id"]) == item["image_url"]:
+            unchanged_count += 1
+            continue
+        url_groups.setdefault(item["image_url"], []).append(item)
+    indexed = None
+
+    logger.info("Found %d images from products (%d unchanged, skipped)", total_images, unchanged_count)
+    if len(url_groups) < total_images - unchanged_count:
+        logger.info("Deduplicated %d images into %d unique URLs", total_images - unchanged_count, len(url_groups))
+
+    # RATE LIMITING: quota 10 requests/minute, chỉ dùng 8/10 cho an toàn.
+    # Token bucket: chỉ chờ khi thực sự hết token; capacity 2 -> burst + refill
+    # trong bất kỳ cửa sổ 60s nào vẫn <= 10 request
+    bucket = TokenBucket(rate=_IMAGE_EMB_RPM / 60.0, capacity=2)
+
+    batch_size = 16  # số ảnh tải song song mỗi lượt
+    failed_count = 0
+    cache_hits = 0
+
+    # Cache embedding theo sha256 nội dung ảnh: giữ qua các lần rebuild (không bị drop)
+    cache_col = mongo.db["image_embedding_cache"]
+
+    # w=1, không chờ journal: collection rebuild lại được từ products nếu mất
+    emb_writer = image_embeddings_col.with_options(write_concern=WriteConcern(w=1, j=False))
+    write_ops = []
+    sync_futures = deque()
+    total_upsert = 0
+
+    def _collect_synced(wait=False):
+        # Lấy ops của các lô đã upsert Vertex xong (theo thứ tự submit), gom rồi flush lô lớn
+        nonlocal write_ops, total_upsert, failed_count
+        while sync_futures and (wait or sync_futures[0].done()):
+            items_count, future = sync_futures.popleft()
+            upserted, ops = future.result()
+            total_upsert += upserted
+            failed_count += items_count - upserted
+            write_ops.extend(ops)
+        if write_ops and (wait or len(write_ops) >= _WRITE_FLUSH_SIZE):
+            writer.submit(_flush_bulk, emb_writer, write_ops)
+            write_ops = []
+
+    # writer: upsert Vertex rồi mới ghi Mongo ở background, chồng lên phần
+    # download/embedding (bị chặn bởi rate limit) của batch kế tiếp
+    with ThreadPoolExecutor(max_workers=_DOWNLOAD_WORKERS) as pool, \
+            ThreadPoolExecutor(max_workers=2) as writer:
+        def _prefetch(batch):
+            # Executor.map submit ngay mọi URL của batch, kết quả lấy ra theo thứ tự
+            return batch, pool.map(_download_image, [url for url, _ in batch])
+
+        batches = _chunks(url_groups.items(), batch_size)
+        first = next(batches, None)
+        pending = _prefetch(first) if first else None
+
+        while pending:
+            batch, downloads = pending
+            # Tải trước batch kế tiếp trong lúc batch hiện tại chờ quota embedding
+            # (lookahead 1 batch -> bộ nhớ ảnh bị chặn ở ~2 batch)
+            nxt = next(batches, None)
+            pending = _prefetch(nxt) if nxt else None
 
-        # Xóa vector cũ từ Vertex
-        if old_ids:
-            try:
-                _vs().remove_image_vectors(old_ids)
-                logger.info("Removed %d old image vectors from Vertex", len(old_ids))
-            except Exception as ve:
-                logger.warning("Could not remove old image vectors: %s", ve)
-
-        # Lấy tất cả images từ tất cả products
-        to_embed = []
-        for p in products_col.find({}, {"_id": 1, "name": 1, "images": 1}):
-            pid = str(p["_id"])
-            images = p.get("images", [])
-            
-            if not images or len(images) == 0:
-                continue
-            
-            for img in images:
-                if isinstance(img, dict):
-                    url = img.get("url")
-                    position = img.get("position", 999)
-                elif isinstance(img, str):
-                    url = img
-                    position = 999
-                else:
-                    continue
-                
-                if not url or not isinstance(url, str):
-                    continue
-                
-                if not url.startswith(('http://', 'https://')):
-                    continue
-                
-                datapoint_id = f"{pid}_{position}"
-                
-                to_embed.append({
-                    "datapoint_id": datapoint_id,
-                    "product_id": pid,
-                    "image_url": url,
-                    "position": position,
-                    "product_name": p.get("name", "")
-                })
-
-        logger.info(f"Found {len(to_embed)} images from products")
-        
-        if to_embed:
-            logger.info(f"Sample images: {to_embed[:3]}")
-
-        # RATE LIMITING: 10 requests/minute = 1 request mỗi 6 giây
-        REQUESTS_PER_MINUTE = 8  # Để an toàn, chỉ dùng 8/10 quota
-        SECONDS_PER_REQUEST = 60.0 / REQUESTS_PER_MINUTE  # = 7.5 giây/request
-        
-        batch_size = 3  # Batch nhỏ để dễ quản lý
-        total_upsert = 0
-        failed_count = 0
-        request_count = 0
-        minute_start = time.time()
-
-        for batch_idx, batch in enumerate(_chunks(to_embed, batch_size)):
             batch_embeddings = []
-            
-            for item in batch:
-                datapoint_id = item["datapoint_id"]
-                img_url = item["image_url"]
-                
-                # Rate limiting: Đợi nếu đã dùng hết quota trong phút này
-                if request_count >= REQUESTS_PER_MINUTE:
-                    elapsed = time.time() - minute_start
-                    if elapsed < 60:
-                        wait_time = 60 - elapsed + 1  # +1 giây để chắc chắn
-                        logger.info(f"Rate limit reached. Waiting {wait_time:.1f}s before next batch...")
-                        time.sleep(wait_time)
-                    # Reset counter
-                    request_count = 0
-                    minute_start = time.time()
-                
+            now = datetime.now()  # 1 timestamp cho mọi write của batch
+
+            # Gom theo sha256 nội dung: ảnh trùng byte (khác URL) cũng chỉ embed 1 lần
+            by_hash = {}  # {sha256: [items, image_bytes]}
+            for (url, items), (image_bytes, err) in zip(batch, downloads):
+                if err:
+                    logger.warning("Failed to download %s: %s", url, err)
+                    failed_count += len(items)
+                    continue
+                h = hashlib.sha256(image_bytes).hexdigest()
+                if h in by_hash:
+                    by_hash[h][0] = by_hash[h][0] + items
+                else:
+                    by_hash[h] = [items, image_bytes]
+
+            # Cache hit -> dùng lại embedding, không tốn quota
+            ready = []  # [(items, image_bytes, sha256)] cần embedding mới
+            cached = {
+                doc["_id"]: doc["embedding"]
+                for doc in cache_col.find(
+                    {"_id": {"$in": list(by_hash)}, "model": vs.image_model_name},
+                    {"embedding": 1}
+                )
+            } if by_hash else {}
+            for h, (items, image_bytes) in by_hash.items():
+                if h in cached:
+                    _fan_out(batch_embeddings, items, _to_vector(cached[h]).tolist())
+                    cache_hits += len(items)
+                else:
+                    ready.append((items, image_bytes, h))
+
+            cache_ops = []
+            for group in _chunks(ready, _EMBED_BATCH_SIZE):
                 try:
-                    headers = {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                    }
-                    response = requests.get(img_url, timeout=15, headers=headers)
-                    
-                    if response.status_code != 200:
-                        logger.warning(f"Failed to download {datapoint_id}: HTTP {response.status_code}")
-                        failed_count += 1
-                        continue
-                    
-                    image_bytes = response.content
-                    
-                    if len(image_bytes) > 10 * 1024 * 1024:  # 10MB
-                        logger.warning(f"Image too large {datapoint_id}: {len(image_bytes)} bytes")
-                        failed_count += 1
-                        continue
-                    
-                    # Tạo embedding - đây là 1 request tính vào quota
-                    emb = _vs().create_image_embedding_from_bytes(image_bytes)
-                    request_count += 1  # Đếm request
-                    
-                    if emb:
-                        batch_embeddings.append({
-                            "datapoint_id": datapoint_id,
-                            "product_id": item["product_id"],
-                            "embedding": emb,
-                            "image_url": img_url,
-                            "position": item["position"],
-                            "product_name": item["product_name"]
-                        })
-                    else:
-                        failed_count += 1
-                    
-                    # Delay giữa các request
-                    time.sleep(SECONDS_PER_REQUEST)
-                    
+                    # Service lấy quota trước từng lời gọi Vertex (1 cho batch predict,
+                    # 1/ảnh khi gọi từng ảnh hoặc fallback)
+                    embs = vs.create_image_embeddings_from_bytes_batch(
+                        [b for _, b, _ in group], acquire=bucket.acquire
+                    )
+
+                    for (items, _, h), emb in zip(group, embs):
+                        if not emb:
+                            failed_count += len(items)
+                            continue
+                        _fan_out(batch_embeddings, items, emb)
+                        cache_ops.append(UpdateOne(
+                            {"_id": h},
+                            # $set: đổi model thì entry cũ bị ghi đè
+                            {"$set": {
+                                "embedding": Binary(np.asarray(emb, dtype=np.float32).tobytes()),
+                                "model": vs.image_model_name,
+                            },
+                             "$setOnInsert": {"created_at": now}},
+                            upsert=True,
+                        ))
+
                 except Exception as e:
-                    logger.warning(f"Failed to embed {datapoint_id}: {e}")
-                    failed_count += 1
+                    logger.warning("Failed to embed %d images: %s", len(group), e)
+                    failed_count += sum(len(items) for items, _, _ in group)
                     continue
 
-            # Lưu vào MongoDB và Vertex
+            if cache_ops:
+                writer.submit(_flush_bulk, cache_col, cache_ops)
+
+            # Upsert Vertex trước, Mongo ghi sau với vertex_synced theo kết quả upsert
             if batch_embeddings:
-                now = datetime.now()
-                docs = []
-                pairs_for_upsert = []
-                
-                for item in batch_embeddings:
-                    docs.append({
-                        "datapoint_id": item["datapoint_id"],
-                        "product_id": item["product_id"],
-                        "embedding": item["embedding"],
-                        "image_url": item["image_url"],
-                        "position": item["position"],
-                        "product_name": item["product_name"],
-                        "created_at": now,
-                    })
-                    pairs_for_upsert.append((item["datapoint_id"], item["embedding"]))
-
-                if docs:
-                    try:
-                        image_embeddings_col.insert_many(docs, ordered=False)
-                    except Exception as me:
-                        logger.error(f"MongoDB insert failed: {me}")
-
-                if pairs_for_upsert:
-                    try:
-                        _vs().upsert_image_vectors(pairs_for_upsert)
-                        total_upsert += len(pairs_for_upsert)
-                        logger.info(f"Upserted {len(pairs_for_upsert)} vectors, total={total_upsert}/{len(to_embed)} ({request_count} requests this minute)")
-                    except Exception as ve:
-                        logger.error(f"Failed to upsert image vectors: {ve}")
+                sync_futures.append(
+                    (len(batch_embeddings), writer.submit(_sync_image_batch, vs, batch_embeddings, now))
+                )
+            _collect_synced()
+
+        _collect_synced(wait=True)
+
+    # Thoát khỏi with: mọi lượt ghi đã xong
+    # Dọn datapoint không còn trong catalog (product/ảnh đã bị xoá). Datapoint lỗi
+    # download/embedding lần này vẫn nằm trong seen_datapoints -> giữ embedding cũ.
+    # Diff phía client trên cursor projection thay vì $nin với cả tập id (tránh query > 16MB)
+    removed = 0
+    cursor = image_embeddings_col.find({}, {"datapoint_id": 1, "_id": 0}).batch_size(1000)
+    stale_ids = (
+        doc["datapoint_id"] for doc in cursor
+        if doc.get("datapoint_id") and doc["datapoint_id"] not in seen_datapoints
+    )
+    for chunk in _chunks(stale_ids, 500):
+        try:
+            vs.remove_image_vectors(chunk)
+        except Exception as ve:
+            logger.warning("Could not remove stale image vectors: %s", ve)
+        image_embeddings_col.delete_many({"datapoint_id": {"$in": chunk}})
+        removed += len(chunk)
+    if removed:
+        logger.info("Removed %d stale image datapoints", removed)
+
+    return {
+        "success": True,
+        "total_images_indexed": total_upsert,
+        "failed_count": failed_count,
+        "cache_hits": cache_hits,
+        "unchanged_count": unchanged_count,
+        "removed_count": removed,
+        "message": f"Indexed {total_upsert} images from all products"
+    }
+
+
+# Job lock + trạng thái rebuild lưu ở Mongo (1 doc): dùng chung cho mọi gunicorn worker/instance,
+# tránh 2 rebuild cùng tiêu quota embedding. Job giữ lease bằng heartbeat; worker chết giữa
+# chừng -> hết lease là job khác claim lại được, /status báo stale.
+_REBUILD_JOB_ID = "rebuild_image_index_multi"
+_REBUILD_LEASE = timedelta(minutes=10)
+_REBUILD_HEARTBEAT_SECONDS = 60
+
+def _jobs_col():
+    return _mongo().db["rebuild_jobs"]
+
+def _claim_rebuild(owner):
+    """Claim job lock (atomic find_one_and_update). Trả về None nếu job khác đang chạy."""
+    now = datetime.now()
+    try:
+        return _jobs_col().find_one_and_update(
+            {"_id": _REBUILD_JOB_ID,
+             "$or": [{"running": {"$ne": True}}, {"heartbeat_at": {"$lt": now - _REBUILD_LEASE}}]},
+            {"$set": {
+                "running": True, "owner": owner, "started_at": now, "heartbeat_at": now,
+                "finished_at": None, "result": None, "error": None,
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Doc đã tồn tại nhưng không khớp filter -> job khác đang giữ lease
+        return None
+
+def _run_claimed_rebuild(owner, force):
+    """Chạy rebuild đã claim: heartbeat gia hạn lease, ghi kết quả + nhả lock khi xong"""
+    jobs_col = _jobs_col()
+    stop = threading.Event()
 
+    def _heartbeat():
+        while not stop.wait(_REBUILD_HEARTBEAT_SECONDS):
+            try:
+                jobs_col.update_one(
+                    {"_id": _REBUILD_JOB_ID, "owner": owner}, {"$set": {"heartbeat_at": datetime.now()}}
+                )
+            except Exception as e:
+                logger.warning("Rebuild heartbeat failed: %s", e)
+
+    threading.Thread(target=_heartbeat, daemon=True).start()
+    result, error = None, None
+    try:
+        result = _run_image_rebuild(force)
+        return result
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        stop.set()
+        try:
+            jobs_col.update_one(
+                {"_id": _REBUILD_JOB_ID, "owner": owner},
+                {"$set": {"running": False, "finished_at": datetime.now(), "result": result, "error": error}},
+            )
+        except Exception as e:
+            logger.error("Failed to release rebuild lock: %s", e)
+
+def _rebuild_in_background(owner, force):
+    try:
+        _run_claimed_rebuild(owner, force)
+    except Exception as e:
+        logger.error("Background multi-image rebuild failed: %s", e)
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+@multi_image_index_bp.route("/rebuild-image-index-multi", methods=["POST"])
+def rebuild_image_index_multi():
+    """
+    Rebuild multi-image index
+
+    ?async=true: chạy ở background thread và trả 202 ngay (rebuild có thể kéo dài hàng giờ
+    vì quota embedding, tránh giữ worker + timeout HTTP); theo dõi qua
+    GET /rebuild-image-index-multi/status. Mặc định chạy đồng bộ như trước.
+
+    ?force=true: embed lại cả ảnh không đổi (vd. sau khi index Vertex bị tạo lại).
+
+    Chỉ 1 rebuild tại 1 thời điểm trên mọi worker (lock ở collection rebuild_jobs) -> 409.
+    """
+    force = request.args.get("force", "").lower() in ("1", "true", "yes")
+    owner = uuid.uuid4().hex
+    try:
+        job = _claim_rebuild(owner)
+    except Exception as e:
+        logger.error(f"Rebuild multi-image index failed: {e}")
+        return jsonify({"error": str(e)}), 500
+    if job is None:
+        current = _jobs_col().find_one({"_id": _REBUILD_JOB_ID}, {"started_at": 1}) or {}
+        return jsonify({"error": "Rebuild already running", "started_at": _iso(current.get("started_at"))}), 409
+
+    if request.args.get("async", "").lower() in ("1", "true", "yes"):
+        threading.Thread(target=_rebuild_in_background, args=(owner, force), daemon=True).start()
         return jsonify({
             "success": True,
-            "total_images_indexed": total_upsert,
-            "failed_count": failed_count,
-            "message": f"Indexed {total_upsert} images from all products"
-        }), 200
+            "status": "accepted",
+            "status_url": "/gemini/index/rebuild-image-index-multi/status"
+        }), 202
 
+    try:
+        return jsonify(_run_claimed_rebuild(owner, force)), 200
     except Exception as e:
         logger.error(f"Rebuild multi-image index failed: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@multi_image_index_bp.route("/rebuild-image-index-multi/status", methods=["GET"])
+def rebuild_image_index_multi_status():
+    job = _jobs_col().find_one({"_id": _REBUILD_JOB_ID}) or {}
+    running = bool(job.get("running"))
+    heartbeat_at = job.get("heartbeat_at")
+    return jsonify({
+        "running": running,
+        # Worker chạy job đã chết (hết lease mà chưa ghi kết quả)
+        "stale": running and isinstance(heartbeat_at, datetime) and heartbeat_at < datetime.now() - _REBUILD_LEASE,
+        "started_at": _iso(job.get("started_at")),
+        "heartbeat_at": _iso(heartbeat_at),
+        "finished_at": _iso(job.get("finished_at")),
+        "result": job.get("result"),
+        "error": job.get("error"),
+    }), 200
+
+
+def _rerank_exact(image_embeddings_col, candidate_product_ids, query_emb, per_product_rerank):
+    """Re-rank chính xác bằng cosine trên tối đa per_product_rerank ảnh/product"""
+    # Query chuẩn hoá 1 lần; embedding lưu sẵn dạng unit -> cosine = 1 phép dot
+    q = _unit_vector(query_emb)
+
+    # 1 round-trip: aggregate chỉ trả về per_product_rerank ảnh đầu (theo position) của mỗi product
+    # ($sort dùng index (product_id, position))
+    docs_by_product = {}
+    cursor = image_embeddings_col.aggregate([
+        {"$match": {"product_id": {"$in": candidate_product_ids}}},
+        {"$sort": {"product_id": 1, "position": 1}},
+        {"$group": {
+            "_id": "$product_id",
+            "docs": {"$push": {
+                "embedding": "$embedding",
+                "image_url": "$image_url",
+                "position": "$position",
+                "datapoint_id": "$datapoint_id",
+                "normalized": "$normalized",
+            }},
+        }},
+        {"$project": {"docs": {"$slice": ["$docs", per_product_rerank]}}},
+    ])
+    for row in cursor:
+        group = []
+        for doc in row["docs"]:
+            if not doc.get("embedding"):
+                continue
+            # doc cũ (trước khi lưu dạng unit) -> chuẩn hoá lúc đọc
+            vec = _to_vector(doc["embedding"]) if doc.get("normalized") else _unit_vector(_to_vector(doc["embedding"]))
+            if vec.shape[0] != q.shape[0]:
+                logger.warning("Skip %s: embedding dim %d != %d", doc.get("datapoint_id"), vec.shape[0], q.shape[0])
+                continue
+            group.append((doc, vec))
+        docs_by_product[row["_id"]] = group
+
+    # Gộp ảnh của mọi product vào 1 ma trận -> 1 phép gemv cho toàn bộ rerank
+    # (nhanh hơn chia thread: mỗi product chỉ vài vector, chi phí dispatch lớn hơn phần tính)
+    flat_docs, vecs, spans = [], [], []
+    for pid in candidate_product_ids:
+        group = docs_by_product.get(pid)
+        if not group:
+            continue
+        spans.append((pid, len(flat_docs), len(flat_docs) + len(group)))
+        for doc, vec in group:
+            flat_docs.append(doc)
+            vecs.append(vec)
+
+    # Re-rank chính xác theo cosine trên tối đa per_product_rerank ảnh/product
+    product_scores = {}  # {product_id: {"similarity": float, "distance": float, "matched_image_url": str, "position": int, "datapoint_id": str}}
+    if vecs:
+        M = np.stack(vecs)
+        sims = M @ q
+        for pid, start, end in spans:
+            i = start + int(np.argmax(sims[start:end]))  # hoà điểm -> ảnh có position nhỏ hơn
+            cos = float(sims[i])
+            doc = flat_docs[i]
+            product_scores[pid] = {
+                "similarity": (cos + 1.0) / 2.0,  # map [-1,1] -> [0,1]
+                # distance từ cosine (nhất quán), trong [0..2]
+                "distance": 1.0 - cos,
+                "matched_image_url": doc.get("image_url"),
+                "position": doc.get("position", 0),
+                "datapoint_id": doc.get("datapoint_id", "")
+            }
+    return product_scores
+
+
+def _scores_from_ann(image_embeddings_col, best_neighbor):
+    """
+    Fast path (per_product_rerank <= 1): dùng luôn ANN distance của neighbor tốt nhất mỗi product,
+    không tải embedding / tính cosine; chỉ 1 query $in lấy image_url + position.
+
+    Chỉ gọi khi _ann_similarity() quy đổi được (COSINE_DISTANCE); similarity/distance
+    trả về cùng thang với _rerank_exact.
+    """
+    meta = {
+        doc["datapoint_id"]: doc
+        for doc in image_embeddings_col.find(
+            {"datapoint_id": {"$in": [dpid for dpid, _ in best_neighbor.values()]}},
+            {"datapoint_id": 1, "image_url": 1, "position": 1, "_id": 0}
+        )
+    }
+    product_scores = {}
+    for pid, (dpid, dist) in best_neighbor.items():
+        similarity = _ann_similarity(dist)
+        doc = meta.get(dpid, {})
+        product_scores[pid] = {
+            "similarity": similarity,
+            # 1 - cos như _rerank_exact, trong [0..2]
+            "distance": 2.0 * (1.0 - similarity),
+            "matched_image_url": doc.get("image_url"),
+            "position": doc.get("position", 0),
+            "datapoint_id": dpid
+        }
+    return product_scores
+
+
 @multi_image_index_bp.route("/search-by-image-multi", methods=["POST"])
 def search_by_image_multi():
     """
@@ -213,20 +681,19 @@ def search_by_image_multi():
     1) Tạo embedding cho ảnh truy vấn.
     2) Gọi ANN với candidate_k cố định (ổn định recall, không phụ thuộc top_k).
     3) Lấy danh sách product ứng viên từ tập neighbor.
-    4) Re-rank chính xác bằng cosine trên tối đa per_product_rerank ảnh/ product.
+    4) Re-rank chính xác bằng cosine trên tối đa per_product_rerank ảnh/ product
+       (per_product_rerank <= 1 và index COSINE_DISTANCE: dùng luôn ANN distance, bỏ qua rerank).
     5) Chuẩn hóa similarity về [0..1], lọc min_similarity và trả về top_k ổn định.
     """
     try:
-        from flask import request
-        import base64
-        from bson import ObjectId
-        import math
+        vs = _vs()
+        mongo = _mongo()
+        products_col = mongo.db["products"]
+        image_embeddings_col = mongo.db["product_image_embeddings"]
 
         # Parse đầu vào
         image_bytes = None
         query_emb = None
-        final_top_k = 5
-        data = {}
 
         content_type = request.content_type or ""
         is_multipart = "multipart/form-data" in content_type
@@ -238,59 +705,58 @@ def search_by_image_multi():
             if file.filename == "":
                 return jsonify({"error": "Empty filename"}), 400
             image_bytes = file.read()
-            try:
-                final_top_k = int(request.form.get("top_k", 5))
-            except Exception:
-                final_top_k = 5
+            params = request.form
         else:
             data = request.get_json(silent=True) or {}
-            try:
-                final_top_k = int(data.get("top_k", 5))
-            except Exception:
-                final_top_k = 5
+            params = data
 
             if "image_base64" in data:
-                image_bytes = base64.b64decode(
-                    data["image_base64"].split(",")[1]
-                    if "," in data["image_base64"]
-                    else data["image_base64"]
-                )
+                # Bỏ prefix data URL ("data:image/...;base64,") nếu có, chỉ quét chuỗi 1 lần
+                b64 = data["image_base64"]
+                _, sep, tail = b64.partition(",")
+                image_bytes = base64.b64decode(tail if sep else b64)
             elif "gcs_uri" in data:
-                query_emb = _vs().create_image_embedding_from_url(data["gcs_uri"])
+                query_emb = vs.create_image_embedding_from_url(data["gcs_uri"])
             else:
                 return jsonify({"error": "No image provided"}), 400
 
+        # Tham số đọc 1 lần từ form (multipart) hoặc JSON body
+        try:
+            final_top_k = int(params.get("top_k", 5))
+        except Exception:
+            final_top_k = 5
+
         # Tham số nâng cao
         default_candidate_k = 300
         max_candidate_k = 1000
         default_per_product_rerank = 8
 
         try:
-            candidate_k = int(request.form.get("candidate_k", default_candidate_k)) if is_multipart else int(data.get("candidate_k", default_candidate_k))
+            candidate_k = int(params.get("candidate_k", default_candidate_k))
         except Exception:
             candidate_k = default_candidate_k
         candidate_k = max(50, min(candidate_k, max_candidate_k))
 
         try:
-            per_product_rerank = int(request.form.get("per_product_rerank", default_per_product_rerank)) if is_multipart else int(data.get("per_product_rerank", default_per_product_rerank))
+            per_product_rerank = int(params.get("per_product_rerank", default_per_product_rerank))
         except Exception:
             per_product_rerank = default_per_product_rerank
         per_product_rerank = max(1, min(per_product_rerank, 16))
 
         # Optional: ngưỡng lọc similarity
         try:
-            min_similarity = float(request.form.get("min_similarity", 0.0)) if is_multipart else float(data.get("min_similarity", 0.0))
+            min_similarity = float(params.get("min_similarity", 0.0))
         except Exception:
             min_similarity = 0.0
 
         # Tạo embedding query
         if image_bytes and not query_emb:
-            query_emb = _vs().create_image_embedding_from_bytes(image_bytes)
+            query_emb = vs.create_image_embedding_from_bytes(image_bytes)
         if not query_emb:
             return jsonify({"error": "Failed to create image embedding"}), 500
 
         # ANN search với candidate_k cố định (không phụ thuộc final_top_k)
-        neighbors = _vs().find_image_neighbors(query_emb, k=candidate_k)
+        neighbors = vs.find_image_neighbors(query_emb, k=candidate_k)
         if not neighbors:
             return jsonify({
                 "success": True,
@@ -300,28 +766,37 @@ def search_by_image_multi():
                 "message": "No similar images found"
             }), 200
 
-        # Ổn định thứ tự neighbor (deterministic tie-break)
-        neighbors = sorted(
-            ((str(dpid), float(dist)) for dpid, dist in neighbors),
-            key=lambda x: (x[1], x[0])
-        )
+        # Ổn định thứ tự neighbor (deterministic tie-break); find_image_neighbors đã trả về
+        # list (id, float distance) -> sort tại chỗ, không dựng lại tuple cho từng neighbor
+        neighbors.sort(key=_NEIGHBOR_ORDER)
 
         # Group product ứng viên theo tập neighbor
-        mongo = current_app.config["MONGODB_SERVICE"]
-        products_col = mongo.db["products"]
-        image_embeddings_col = mongo.db["product_image_embeddings"]
-
+        # neighbors đã sort theo distance tăng dần -> lần đầu gặp 1 product là ANN distance tốt nhất,
+        # candidate_product_ids giữ đúng thứ tự ước lượng ANN
+        # Cap + prefilter chỉ khi ANN distance quy được ra similarity (COSINE_DISTANCE);
+        # measure khác/chưa cấu hình -> rerank mọi product ứng viên như trước
+        ann_cosine = _ann_similarity(0.0) is not None
+        max_rerank_products = max(_RERANK_MAX_PRODUCTS, final_top_k) if ann_cosine else None
+        min_ann_similarity = min_similarity - _ANN_PREFILTER_EPS
+        ann_prefilter = ann_cosine and min_similarity > 0.0
         candidate_product_ids = []
+        best_neighbor = {}  # {product_id: (datapoint_id, ANN distance)}
         seen = set()
-        for datapoint_id, _ in neighbors:
-            parts = datapoint_id.rsplit("_", 1)
-            if len(parts) != 2:
-                logger.warning(f"Invalid datapoint_id format: {datapoint_id}")
+        seen_add = seen.add
+        for datapoint_id, dist in neighbors:
+            pid, sep, _ = datapoint_id.rpartition("_")
+            if not sep:
+                logger.warning("Invalid datapoint_id format: %s", datapoint_id)
                 continue
-            pid = parts[0]
             if pid not in seen:
-                seen.add(pid)
+                # Ước lượng similarity từ ANN distance; các neighbor sau còn xa hơn
+                if ann_prefilter and _ann_similarity(dist) < min_ann_similarity:
+                    break
+                seen_add(pid)
                 candidate_product_ids.append(pid)
+                best_neighbor[pid] = (datapoint_id, dist)
+                if max_rerank_products and len(candidate_product_ids) >= max_rerank_products:
+                    break
 
         if not candidate_product_ids:
             return jsonify({
@@ -332,61 +807,13 @@ def search_by_image_multi():
                 "message": "No products found"
             }), 200
 
-        # Helper: cosine
-        def _cosine(a, b):
-            try:
-                n = min(len(a), len(b))
-                if n == 0:
-                    return 0.0
-                dot = 0.0
-                sa = 0.0
-                sb = 0.0
-                for i in range(n):
-                    ai = float(a[i])
-                    bi = float(b[i])
-                    dot += ai * bi
-                    sa += ai * ai
-                    sb += bi * bi
-                if sa == 0.0 or sb == 0.0:
-                    return 0.0
-                return dot / ((sa ** 0.5) * (sb ** 0.5))
-            except Exception:
-                return 0.0
-
-        # Re-rank chính xác theo cosine trên tối đa per_product_rerank ảnh/product
-        product_scores = {}  # {product_id: {"similarity": float, "distance": float, "matched_image_url": str, "position": int, "datapoint_id": str}}
-        for pid in candidate_product_ids:
-            best = None
-            try:
-                cursor = image_embeddings_col.find(
-                    {"product_id": pid},
-                    {"embedding": 1, "image_url": 1, "position": 1, "datapoint_id": 1}
-                ).sort("position", 1).limit(per_product_rerank)
-
-                for doc in cursor:
-                    emb = doc.get("embedding")
-                    if not emb:
-                        continue
-                    cos = _cosine(query_emb, emb)
-                    similarity = (cos + 1.0) / 2.0  # map [-1,1] -> [0,1]
-                    # distance từ cosine (nhất quán), trong [0..2]
-                    distance = 1.0 - cos
-                    cand = {
-                        "similarity": float(similarity),
-                        "distance": float(distance),
-                        "matched_image_url": doc.get("image_url"),
-                        "position": doc.get("position", 0),
-                        "datapoint_id": doc.get("datapoint_id", "")
-                    }
-                    if (best is None) or (cand["similarity"] > best["similarity"]) or (
-                        cand["similarity"] == best["similarity"] and (cand["distance"] < best["distance"] or cand["datapoint_id"] < best.get("datapoint_id", ""))
-                    ):
-                        best = cand
-            except Exception as e:
-                logger.warning(f"Re-rank failed for product {pid}: {e}")
-
-            if best:
-                product_scores[pid] = best
+        # Fast path cần quy đổi ANN distance -> similarity; measure khác thì rerank chính xác
+        if per_product_rerank <= 1 and _ann_similarity(0.0) is not None:
+            product_scores = _scores_from_ann(image_embeddings_col, best_neighbor)
+        else:
+            product_scores = _rerank_exact(
+                image_embeddings_col, candidate_product_ids, query_emb, per_product_rerank
+            )
 
         if not product_scores:
             return jsonify({
@@ -397,13 +824,14 @@ def search_by_image_multi():
                 "message": "No products found after rerank"
             }), 200
 
-        # Lọc theo min_similarity và sort ổn định
+        # Lọc theo min_similarity, lấy top_k ổn định (partial top-K, không sort toàn bộ)
         filtered = [(pid, info) for pid, info in product_scores.items() if info["similarity"] >= min_similarity]
 
-        sorted_products = sorted(
+        sorted_products = heapq.nsmallest(
+            final_top_k,
             filtered,
             key=lambda x: (-x[1]["similarity"], x[1]["distance"], x[1]["datapoint_id"])
-        )[:final_top_k]
+        )
 
         logger.info(
             f"Search candidates={len(candidate_product_ids)} reranked={len(product_scores)} "
@@ -411,16 +839,14 @@ def search_by_image_multi():
             f"(candidate_k={candidate_k}, per_product_rerank={per_product_rerank}, top_k={final_top_k})"
         )
 
-        # Batch query products
-        product_ids = [pid for pid, _ in sorted_products]
-        oids = []
-        for pid in product_ids:
-            try:
-                oids.append(ObjectId(pid) if ObjectId.is_valid(pid) else pid)
-            except Exception:
-                oids.append(pid)
+        # Batch query products (is_valid đã chặn trước nên ObjectId() không raise)
+        is_valid = ObjectId.is_valid
+        oids = [ObjectId(pid) if is_valid(pid) else pid for pid, _ in sorted_products]
 
-        products_dict = {str(p["_id"]): p for p in products_col.find({"_id": {"$in": oids}})}
+        products_dict = {
+            str(p["_id"]): p
+            for p in products_col.find({"_id": {"$in": oids}}, _RESULT_PRODUCT_PROJECTION)
+        }
 
         # Build results
         results = []
@@ -2,20 +2,33 @@
 from flask import Blueprint, request, jsonify, current_app
 from datetime import datetime
 from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
 
 products_bp = Blueprint("products_bp", __name__)
 
+# Bỏ field nội bộ nặng (text dùng để embedding) khỏi danh sách trả về client
+_LIST_PROJECTION = {"text_indexed": 0}
+
+# Service singletons, gán một lần khi blueprint được register
+_VERTEX = None
+_MONGO = None
+
+
+@products_bp.record_once
+def _bind_services(state):
+    global _VERTEX, _MONGO
+    _VERTEX = state.app.config.get("VERTEX_AI_SERVICE")
+    _MONGO = state.app.config.get("MONGODB_SERVICE")
+
 def _vs():
-    svc = current_app.config.get("VERTEX_AI_SERVICE")
-    if not svc:
+    if not _VERTEX:
         raise RuntimeError("VERTEX_AI_SERVICE chưa được khởi tạo trong app.config")
-    return svc
+    return _VERTEX
 
 def _mongo():
-    svc = current_app.config.get("MONGODB_SERVICE")
-    if not svc:
+    if not _MONGO:
         raise RuntimeError("MONGODB_SERVICE chưa được khởi tạo trong app.config")
-    return svc
+    return _MONGO
 
 @products_bp.route("/", methods=["POST"])
 def add_product():
@@ -37,14 +50,15 @@ def add_product():
         products_col = mongo.db["products"]
         embeddings_col = mongo.db["product_embeddings"]
 
+        now = datetime.now()
         product = {
             "name": data["name"],
             "description": data["description"],
             "category": data.get("category", ""),
             "price": data.get("price", 0),
             "metadata": data.get("metadata", {}),
-            "created_at": datetime.now(),
-            "updated_at": datetime.now(),
+            "created_at": now,
+            "updated_at": now,
         }
         result = products_col.insert_one(product)
         product_id = str(result.inserted_id)
@@ -53,7 +67,8 @@ def add_product():
             "product_id": product_id,
             "embedding": embedding,
             "text": text,
-            "created_at": datetime.now()
+            "created_at": now,
+            "updated_at": now
         })
 
         # Upsert vào Vector Search (không làm fail toàn request nếu lỗi)
@@ -83,6 +98,8 @@ def add_products_batch():
 
         added, errors = 0, []
         to_upsert = []
+        now = datetime.now()  # 1 timestamp cho cả batch
+        valid = []  # [(idx, product doc, text, embedding)] ghi 1 lần bằng insert_many
 
         for idx, p in enumerate(items):
             try:
@@ -105,23 +122,51 @@ def add_products_batch():
                     "category": p.get("category", ""),
                     "price": p.get("price", 0),
                     "metadata": p.get("metadata", {}),
-                    "created_at": datetime.now(),
-                    "updated_at": datetime.now(),
+                    "created_at": now,
+                    "updated_at": now,
                 }
-                res = products_col.insert_one(doc)
-                pid = str(res.inserted_id)
+                valid.append((idx, doc, text, emb))
 
-                embeddings_col.insert_one({
+            except Exception as ex:
+                errors.append(f"Product {idx}: {ex}")
+
+        if valid:
+            # 1 round-trip cho cả batch; insert_many gán _id vào từng doc phía client
+            failed = set()
+            try:
+                products_col.insert_many([doc for _, doc, _, _ in valid], ordered=False)
+            except BulkWriteError as bwe:
+                for err in bwe.details.get("writeErrors", []):
+                    failed.add(err["index"])
+                    errors.append(f"Product {valid[err['index']][0]}: {err.get('errmsg')}")
+
+            emb_docs = []
+            for i, (idx, doc, text, emb) in enumerate(valid):
+                if i in failed:
+                    continue
+                pid = str(doc["_id"])
+                emb_docs.append({
                     "product_id": pid,
                     "embedding": emb,
                     "text": text,
-                    "created_at": datetime.now()
+                    "created_at": now,
+                    "updated_at": now
                 })
-                added += 1
-                to_upsert.append((pid, emb))
 
-            except Exception as ex:
-                errors.append(f"Product {idx}: {ex}")
+            if emb_docs:
+                emb_failed = set()
+                try:
+                    embeddings_col.insert_many(emb_docs, ordered=False)
+                except BulkWriteError as bwe:
+                    for err in bwe.details.get("writeErrors", []):
+                        emb_failed.add(err["index"])
+                        errors.append(f"Embedding {emb_docs[err['index']]['product_id']}: {err.get('errmsg')}")
+                # Chỉ upsert vector cho product đã có embedding doc
+                to_upsert = [
+                    (d["product_id"], d["embedding"])
+                    for i, d in enumerate(emb_docs) if i not in emb_failed
+                ]
+                added = len(to_upsert)
 
         if to_upsert:
             try:
@@ -150,10 +195,12 @@ def get_products():
         limit = int(request.args.get("limit", 100))
         skip = int(request.args.get("skip", 0))
 
-        docs = list(products_col.find().skip(skip).limit(limit))
-        for d in docs:
+        docs = []
+        for d in products_col.find({}, _LIST_PROJECTION).skip(skip).limit(limit):
             d["_id"] = str(d["_id"])
-        total = products_col.count_documents({})
+            docs.append(d)
+        # Không filter -> đọc count từ metadata collection thay vì scan
+        total = products_col.estimated_document_count()
         return jsonify({"success": True, "total": total, "products": docs}), 200
     except Exception as e:
         current_app.logger.exception("get_products failed")
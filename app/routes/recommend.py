@@ -2,44 +2,56 @@
 from flask import Blueprint, request, jsonify, current_app
 from bson import ObjectId
 import logging
-from collections import defaultdict
+import heapq
+import threading
+import time
+import numpy as np
 
 recommend_bp = Blueprint("recommend_bp", __name__)
 logger = logging.getLogger(__name__)
 
+# Service singletons, gán một lần khi blueprint được register
+_VERTEX = None
+_MONGO = None
+_EVENT = None
+
+
+@recommend_bp.record_once
+def _bind_services(state):
+    global _VERTEX, _MONGO, _EVENT
+    _VERTEX = state.app.config.get("VERTEX_AI_SERVICE")
+    _MONGO = state.app.config.get("MONGODB_SERVICE")
+    _EVENT = state.app.config.get("EVENT_SERVICE")
+
 def _vs():
-    svc = current_app.config.get("VERTEX_AI_SERVICE")
-    if not svc:
+    if not _VERTEX:
         raise RuntimeError("VERTEX_AI_SERVICE chưa được khởi tạo")
-    return svc
+    return _VERTEX
 
 def _mongo():
-    svc = current_app.config.get("MONGODB_SERVICE")
-    if not svc:
+    if not _MONGO:
         raise RuntimeError("MONGODB_SERVICE chưa được khởi tạo")
-    return svc
+    return _MONGO
 
 def _event():
-    svc = current_app.config.get("EVENT_SERVICE")
-    if not svc:
+    if not _EVENT:
         raise RuntimeError("EVENT_SERVICE chưa được khởi tạo")
-    return svc
+    return _EVENT
 
-def _get_product_by_any_id(col, pid: str):
-    """Tìm product theo nhiều khả năng id (reuse từ similar.py)."""
-    if ObjectId.is_valid(pid):
-        p = col.find_one({"_id": ObjectId(pid)})
-        if p:
-            return p
-    p = col.find_one({"_id": pid})
-    if p:
-        return p
-    return col.find_one({"id": pid})
+def _by_weight(item):
+    """Key top-N (product_id, weight): $group không giữ thứ tự -> hoà điểm xét thêm product_id cho ổn định"""
+    return item[1], str(item[0])
+
+# Trọng số theo loại event (loại khác: 1.0)
+_EVENT_WEIGHTS = {"purchase": 3.0, "wishlist": 2.0, "cart": 1.5, "view": 1.0}
+_MS_PER_DAY = 24 * 60 * 60 * 1000
 
 def _get_user_interacted_products(user_id: str, event_types: list = None, limit: int = 50):
-    """Lấy danh sách product_id user đã tương tác, với trọng số theo loại event."""
-    from datetime import datetime
-    
+    """
+    Lấy danh sách product_id user đã tương tác, với trọng số theo loại event.
+
+    Trả về {product_id: weight} không sắp xếp; caller lấy top-N bằng heapq.nlargest.
+    """
     mongo = _mongo()
     events_col = mongo.db["events"]  # Collection name từ screenshot
     
@@ -48,63 +60,51 @@ def _get_user_interacted_products(user_id: str, event_types: list = None, limit:
     if event_types:
         query["type"] = {"$in": event_types}
     
-    # Sort theo ts (timestamp field trong MongoDB)
-    events = list(events_col.find(query).sort("ts", -1).limit(limit))
-    
-    logger.info(f"[DEBUG] User {user_id} has {len(events)} events from MongoDB")
-    
-    if not events:
-        logger.warning(f"[DEBUG] No events found for userId={user_id}")
-        return {}
-    
-    interacted = defaultdict(lambda: {"weight": 0.0, "latest_time": None})
-    weights = {"purchase": 3.0, "wishlist": 2.0, "cart": 1.5, "view": 1.0}
-    
-    for event in events:
+    # Trọng số + time decay + group theo productId chạy phía server: chỉ trả về 1 dòng / product.
+    # limit áp dụng trên các event mới nhất (index userId + ts) như trước.
+    # ts có thể là Date hoặc chuỗi ISO -> $convert, không parse được thì không decay.
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"ts": -1}},
+        {"$limit": limit},
         # FIX: Dùng productId thay vì product_id
-        pid = event.get("productId")
-        if not pid:
-            logger.warning(f"[DEBUG] Event missing productId: {event.get('_id')}")
-            continue
-        
-        etype = event.get("type")
-        # FIX: Dùng ts thay vì timestamp
-        timestamp = event.get("ts") or event.get("timestamp") or event.get("created_at")
-        
-        weight = weights.get(etype, 1.0)
-        
-        # Time decay
-        if timestamp:
-            try:
-                if isinstance(timestamp, str):
-                    event_time = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                else:
-                    # ts có thể là datetime object từ MongoDB
-                    event_time = timestamp
-                
-                # Ensure timezone aware
-                if event_time.tzinfo is None:
-                    from datetime import timezone
-                    event_time = event_time.replace(tzinfo=timezone.utc)
-                
-                now = datetime.now(event_time.tzinfo)
-                days_old = (now - event_time).days
-                decay = max(0.5, 1.0 - (days_old / 365))
-                weight *= decay
-            except Exception as e:
-                logger.warning(f"[DEBUG] Failed to parse timestamp {timestamp}: {e}")
-        
-        interacted[pid]["weight"] += weight
-        if not interacted[pid]["latest_time"] or (timestamp and timestamp > interacted[pid]["latest_time"]):
-            interacted[pid]["latest_time"] = timestamp
+        {"$match": {"productId": {"$nin": [None, ""]}}},
+        {"$project": {
+            "_id": 0,
+            "productId": 1,
+            "w": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$type", etype]}, "then": w}
+                    for etype, w in _EVENT_WEIGHTS.items()
+                ],
+                "default": 1.0,
+            }},
+            "event_time": {"$convert": {
+                "input": {"$ifNull": ["$ts", {"$ifNull": ["$timestamp", "$created_at"]}]},
+                "to": "date", "onError": None, "onNull": None,
+            }},
+        }},
+        {"$group": {
+            "_id": "$productId",
+            "weight": {"$sum": {"$cond": [
+                {"$eq": ["$event_time", None]},
+                "$w",
+                # decay = max(0.5, 1 - days_old / 365), days_old = số ngày tròn
+                {"$multiply": ["$w", {"$max": [0.5, {"$subtract": [1.0, {"$divide": [
+                    {"$floor": {"$divide": [{"$subtract": ["$$NOW", "$event_time"]}, _MS_PER_DAY]}},
+                    365,
+                ]}]}]}]},
+            ]}},
+        }},
+    ]
+    interacted = {doc["_id"]: doc["weight"] for doc in events_col.aggregate(pipeline)}
     
-    logger.info(f"[DEBUG] Found {len(interacted)} unique products for user {user_id}")
-    if interacted:
-        top_3 = list(interacted.items())[:3]
-        logger.info(f"[DEBUG] Top 3 products: {top_3}")
+    if not interacted:
+        logger.warning("[DEBUG] No events found for userId=%s", user_id)
+        return {}
     
-    result = {k: v["weight"] for k, v in interacted.items()}
-    return dict(sorted(result.items(), key=lambda x: x[1], reverse=True))
+    logger.info("[DEBUG] Found %d unique products for user %s", len(interacted), user_id)
+    return interacted
 
 
 
@@ -117,6 +117,32 @@ def _get_product(col, pid: str):
     if p: return p
     return col.find_one({"id": pid})
 
+def _document_embeddings(products):
+    """
+    Embedding RETRIEVAL_DOCUMENT cho list product (cùng thứ tự, [] nếu lỗi)
+
+    Catalog đã lưu sẵn trong product_embeddings (rebuild-index) -> 1 query $in,
+    chỉ gọi Vertex (1 request batch) cho product chưa được index
+    """
+    stored = {
+        doc["product_id"]: doc["embedding"]
+        for doc in _mongo().db["product_embeddings"].find(
+            {"product_id": {"$in": [str(p["_id"]) for p in products]}},
+            {"product_id": 1, "embedding": 1, "_id": 0}
+        )
+        if doc.get("embedding")
+    }
+    embs = [stored.get(str(p["_id"])) for p in products]
+    misses = [i for i, emb in enumerate(embs) if not emb]
+    if misses:
+        texts = [
+            products[i].get("text_indexed") or f"{products[i].get('name', '')}. {products[i].get('description', '')}"
+            for i in misses
+        ]
+        for i, emb in zip(misses, _vs().create_embeddings_batch(texts, task_type="RETRIEVAL_DOCUMENT")):
+            embs[i] = emb
+    return [emb or [] for emb in embs]
+
 @recommend_bp.route("/user/<user_id>", methods=["GET"])
 def recommend_for_user(user_id):
     """
@@ -147,71 +173,94 @@ def recommend_for_user(user_id):
         col = mongo.db[current_app.config.get("COLLECTION_NAME", "products")]
         
         # Lấy top 10 products quan trọng nhất để tạo profile
-        top_interacted = list(interacted.items())[:10]
-        user_texts = []
+        top_interacted = heapq.nlargest(10, interacted.items(), key=_by_weight)
+        profile_products, profile_weights = [], []
+        interacted_products = mongo.get_products_by_any_ids([pid for pid, _ in top_interacted], col.name)
         
         for pid, weight in top_interacted:
-            product = _get_product_by_any_id(col, pid)
+            product = interacted_products.get(pid)
             if not product:
                 logger.warning(f"[DEBUG] Product {pid} not found in products collection")
                 continue
-            text = product.get("text_indexed") or f"{product.get('name', '')}. {product.get('description', '')}"
-            user_texts.append(text)
+            profile_products.append(product)
+            profile_weights.append(weight)
         
-        if not user_texts:
+        if not profile_products:
             logger.warning("No valid products found from user history")
             return _get_popular_products(top_k)
         
-        logger.info(f"Creating user profile from {len(user_texts)} products")
+        # Top 5 products
+        profile_products, profile_weights = profile_products[:5], profile_weights[:5]
+        logger.info("Creating user profile from %d products", len(profile_products))
         
-        # Tạo user profile embedding (trung bình có trọng số)
-        user_profile_text = " | ".join(user_texts[:5])  # Ghép top 5 products
-        user_emb = _vs().create_embedding(user_profile_text, task_type="RETRIEVAL_QUERY")
+        # Tạo user profile embedding: trung bình có trọng số các embedding product (giữ trọng số
+        # từng product thay vì ghép text), chuẩn hoá L2
+        user_emb = None
+        pairs = [(emb, w) for emb, w in zip(_document_embeddings(profile_products), profile_weights) if emb]
+        if pairs:
+            vecs = np.asarray([emb for emb, _ in pairs], dtype=np.float32)
+            wts = np.asarray([w for _, w in pairs], dtype=np.float32)
+            profile = (vecs * wts[:, None]).sum(axis=0) / wts.sum()
+            norm = float(np.linalg.norm(profile))
+            if norm:
+                user_emb = (profile / norm).tolist()
         
         if not user_emb:
-            logger.warning("Failed to create user embedding, fallback to individual products")
-            return _recommend_by_individual_products(user_id, interacted, col, top_k)
+            # _document_embeddings đã thử cả product_embeddings lẫn Vertex cho các product này
+            logger.warning("Failed to create user embedding, returning popular products")
+            return _get_popular_products(top_k)
         
         # 3. Tìm candidates từ vector search
         exclude_ids = set(interacted.keys())
         neighbors = _vs().find_neighbors(user_emb, k=top_k * 3)  # Lấy nhiều để filter
         
-        candidates = {}
-        seen_categories = defaultdict(int)  # Track category diversity
+        neighbor_products = mongo.get_products_by_any_ids(
+            [str(nid) for nid, _ in neighbors if str(nid) not in exclude_ids], col.name
+        )
         
+        # Pool ứng viên theo thứ tự ANN: (id, distance, product, mã category; -1 = không có)
+        pool = []
+        cat_codes = {}  # Track category diversity
         for nid, dist in neighbors:
             nid_str = str(nid)
             if nid_str in exclude_ids:
                 continue
             
-            product = _get_product_by_any_id(col, nid_str)
+            product = neighbor_products.get(nid_str)
             if not product:
                 continue
             
-            # Tính similarity score (1 - distance)
-            sim_score = max(0, 1.0 - float(dist))
-            
-            # Diversity penalty: giảm score nếu category đã có nhiều
             category = product.get("category") or product.get("categoryId")
-            if category and diversity > 0:
-                category_count = seen_categories.get(category, 0)
-                diversity_penalty = diversity * (category_count * 0.1)  # Mỗi item cùng category giảm 10%
-                sim_score *= (1.0 - min(0.5, diversity_penalty))
+            code = cat_codes.setdefault(category, len(cat_codes)) if category else -1
+            pool.append((nid_str, float(dist), product, code))
             
-            candidates[nid_str] = {
-                "score": sim_score,
-                "product": product,
-                "category": category
-            }
-            
-            if category:
-                seen_categories[category] += 1
-            
-            if len(candidates) >= top_k * 2:
+            if len(pool) >= top_k * 2:
                 break
         
-        # 4. Sort và lấy top
-        sorted_candidates = sorted(candidates.items(), key=lambda x: x[1]["score"], reverse=True)[:top_k]
+        sorted_candidates = []
+        if pool:
+            # Tính similarity score (1 - distance)
+            sims = np.maximum(0.0, 1.0 - np.fromiter((c[1] for c in pool), dtype=np.float64, count=len(pool)))
+            
+            # 4. Chọn top. Không diversity: sort (stable -> hoà điểm giữ thứ tự ANN)
+            if diversity <= 0:
+                top = np.argsort(-sims, kind="stable")[:top_k]
+                sorted_candidates = [(pool[i][0], {"score": float(sims[i]), "product": pool[i][2]}) for i in top]
+            else:
+                # Chọn tham lam kiểu MMR: mỗi lượt penalty tính theo số item cùng category ĐÃ ĐƯỢC
+                # CHỌN (mỗi item giảm 10%, tối đa 50%), không phụ thuộc thứ tự ANN của pool
+                codes = np.fromiter((c[3] for c in pool), dtype=np.int64, count=len(pool))
+                has_cat = codes >= 0
+                picked_per_cat = np.zeros(len(cat_codes) + 1)  # slot cuối cho item không có category
+                taken = np.zeros(len(pool), dtype=bool)
+                for _ in range(min(top_k, len(pool))):
+                    overlap = np.where(has_cat, picked_per_cat[codes], 0.0)
+                    scores = sims * (1.0 - np.minimum(0.5, diversity * overlap * 0.1))
+                    scores[taken] = -np.inf
+                    i = int(np.argmax(scores))  # hoà điểm -> index nhỏ nhất (thứ tự ANN)
+                    taken[i] = True
+                    picked_per_cat[codes[i]] += 1
+                    sorted_candidates.append((pool[i][0], {"score": float(scores[i]), "product": pool[i][2]}))
         
         results = []
         for pid, data in sorted_candidates:
@@ -235,83 +284,71 @@ def recommend_for_user(user_id):
         logger.exception("recommend_for_user failed")
         return jsonify({"error": str(e)}), 500
 
-def _recommend_by_individual_products(user_id, interacted, col, top_k):
-    """Fallback: Tìm similar từng product rồi aggregate (logic cũ nhưng cải thiện)"""
-    candidates = defaultdict(lambda: {"score": 0.0, "count": 0})
-    exclude_ids = set(interacted.keys())
-    
-    # Chỉ lấy top 5 interacted products quan trọng nhất
-    top_interacted = list(interacted.items())[:5]
-    
-    for pid, weight in top_interacted:
-        product = _get_product_by_any_id(col, pid)
-        if not product:
-            continue
-        
-        text = product.get("text_indexed") or f"{product.get('name', '')}. {product.get('description', '')}"
-        emb = _vs().create_embedding(text, task_type="RETRIEVAL_DOCUMENT")
-        if not emb:
-            continue
-        
-        neighbors = _vs().find_neighbors(emb, k=top_k * 2)
-        
-        for nid, dist in neighbors:
-            nid_str = str(nid)
-            if nid_str in exclude_ids:
-                continue
-            
-            sim_score = max(0, 1.0 - float(dist))
-            # Normalize by count để tránh bias
-            candidates[nid_str]["score"] += sim_score * weight
-            candidates[nid_str]["count"] += 1
-    
-    # Normalize scores
-    for pid in candidates:
-        if candidates[pid]["count"] > 0:
-            candidates[pid]["score"] /= candidates[pid]["count"]
-    
-    sorted_candidates = sorted(candidates.items(), key=lambda x: x[1]["score"], reverse=True)[:top_k]
-    
-    results = []
-    for pid, data in sorted_candidates:
-        product = _get_product_by_any_id(col, pid)
-        if product:
-            product["_id"] = str(product.get("_id", pid))
-            results.append({
-                "product": product,
-                "recommend_score": round(data["score"], 4)
-            })
-    
-    return jsonify({
-        "success": True,
-        "user_id": user_id,
-        "strategy": "aggregated_content_based",
-        "total_recommendations": len(results),
-        "recommendations": results
-    }), 200
+# Top products phổ biến được materialize vào collection riêng, làm mới tối đa mỗi 5 phút
+# thay vì $group toàn bộ events ở mỗi request fallback
+_POPULAR_COLLECTION = "popular_products"
+_POPULAR_TTL = 300.0
+_POPULAR_MAX = 200
+_popular_refreshed_at = 0.0  # monotonic, 0 = process này chưa refresh lần nào
+_POPULAR_LOCK = threading.Lock()
 
+def _popular_pipeline(limit: int):
+    # Group by productId (not product_id)
+    return [
+        # Chỉ giữ productId trước $group (không kéo payload event qua pipeline)
+        {"$project": {"_id": 0, "productId": 1}},
+        {"$group": {"_id": "$productId", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": limit}
+    ]
+
+def _refresh_popular_products(events_col):
+    """$out thay thế nguyên collection (atomic): reader không thấy trạng thái nửa chừng"""
+    try:
+        events_col.aggregate(_popular_pipeline(_POPULAR_MAX) + [{"$out": _POPULAR_COLLECTION}])
+        logger.info("Refreshed %s", _POPULAR_COLLECTION)
+    except Exception as e:
+        logger.warning("Failed to refresh %s: %s", _POPULAR_COLLECTION, e)
+    finally:
+        _POPULAR_LOCK.release()
+
+def _ensure_popular_fresh(db):
+    """Refresh khi quá TTL: lần đầu chạy đồng bộ, sau đó ở background (request dùng bản hiện có)"""
+    global _popular_refreshed_at
+    now = time.monotonic()
+    if _popular_refreshed_at and now - _popular_refreshed_at < _POPULAR_TTL:
+        return
+    if not _POPULAR_LOCK.acquire(blocking=False):
+        return  # đang có refresh khác chạy
+    first = not _popular_refreshed_at
+    _popular_refreshed_at = now
+    if first:
+        _refresh_popular_products(db["events"])
+    else:
+        threading.Thread(target=_refresh_popular_products, args=(db["events"],), daemon=True).start()
 
 def _get_popular_products(top_k: int):
     """Fallback: Top products phổ biến dựa trên số events."""
     try:
         mongo = _mongo()
-        events_col = mongo.db["events"]  # FIX: Collection name
         
-        # Group by productId (not product_id)
-        pipeline = [
-            {"$group": {"_id": "$productId", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": top_k}
-        ]
-        popular = list(events_col.aggregate(pipeline))
+        _ensure_popular_fresh(mongo.db)
+        if top_k <= _POPULAR_MAX:
+            popular = list(mongo.db[_POPULAR_COLLECTION].find().sort("count", -1).limit(top_k))
+        else:
+            popular = []
+        if not popular:
+            # View chưa có dữ liệu (refresh lỗi) hoặc top_k vượt kích thước view -> tính trực tiếp
+            popular = list(mongo.db["events"].aggregate(_popular_pipeline(top_k)))  # FIX: Collection name
         
         col = mongo.db[current_app.config.get("COLLECTION_NAME", "products")]
         results = []
+        popular_products = mongo.get_products_by_any_ids([doc["_id"] for doc in popular if doc["_id"]], col.name)
         for doc in popular:
             pid = doc["_id"]
             if not pid:
                 continue
-            product = _get_product_by_any_id(col, pid)
+            product = popular_products.get(str(pid))
             if product:
                 product["_id"] = str(product.get("_id", pid))
                 results.append({
@@ -351,9 +388,8 @@ def recommend_for_product(product_id):
         if not prod:
             return jsonify({"error": "Product not found"}), 404
 
-        # Ưu tiên text_indexed nếu có
-        text = prod.get("text_indexed") or f"{prod.get('name','')}. {prod.get('description','')}"
-        emb = _vs().create_embedding(text, task_type="RETRIEVAL_DOCUMENT")
+        # Embedding đã lưu trong product_embeddings; chưa index thì embed text_indexed / name + description
+        emb = _document_embeddings([prod])[0]
         if not emb:
             return jsonify({"error": "Failed to create embedding"}), 500
 
@@ -361,11 +397,12 @@ def recommend_for_product(product_id):
         self_id = str(prod.get("_id") or prod.get("id") or product_id)
 
         results = []
+        neighbor_products = mongo.get_products_by_any_ids([str(nid) for nid, _ in neighbors], prod_col.name)
         for nid, dist in neighbors:
             nid = str(nid)
             if not include_self and nid == self_id:
                 continue
-            p = _get_product(prod_col, nid)
+            p = neighbor_products.get(nid)
             if not p:
                 continue
             p["_id"] = str(p.get("_id", nid))
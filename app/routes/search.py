@@ -1,37 +1,32 @@
 # app/routes/search.py
 from flask import Blueprint, current_app, request, jsonify
-from bson import ObjectId
+from concurrent.futures import ThreadPoolExecutor
 
 search_bp = Blueprint("search_bp", __name__)
 
+# Chạy song song các query Mongo độc lập của 1 request (hydrate product + snippet)
+_LOOKUP_POOL = ThreadPoolExecutor(max_workers=8)
+
+# Service singletons, gán một lần khi blueprint được register
+_VERTEX = None
+_MONGO = None
+
+
+@search_bp.record_once
+def _bind_services(state):
+    global _VERTEX, _MONGO
+    _VERTEX = state.app.config.get("VERTEX_AI_SERVICE")
+    _MONGO = state.app.config.get("MONGODB_SERVICE")
+
 def _vs():
-    svc = current_app.config.get("VERTEX_AI_SERVICE")
-    if not svc:
+    if not _VERTEX:
         raise RuntimeError("VERTEX_AI_SERVICE chưa được khởi tạo")
-    return svc
+    return _VERTEX
 
 def _mongo():
-    svc = current_app.config.get("MONGODB_SERVICE")
-    if not svc:
+    if not _MONGO:
         raise RuntimeError("MONGODB_SERVICE chưa được khởi tạo")
-    return svc
-
-def _get_product_by_any_id(col, nid: str):
-    """Thử map id trả về từ VS vào Mongo:
-       - Nếu nid là ObjectId hợp lệ → tìm theo _id(ObjectId)
-       - Nếu không → thử _id string
-       - Cuối cùng → thử field 'id' (nếu có)"""
-    # 1) _id = ObjectId
-    if ObjectId.is_valid(nid):
-        p = col.find_one({"_id": ObjectId(nid)})
-        if p:
-            return p
-    # 2) _id = string
-    p = col.find_one({"_id": nid})
-    if p:
-        return p
-    # 3) field 'id'
-    return col.find_one({"id": nid})
+    return _MONGO
 
 @search_bp.route("/search", methods=["POST"])
 def semantic_search():
@@ -63,12 +58,23 @@ def semantic_search():
 
         # 3) Lấy chi tiết sản phẩm từ Mongo + áp filter (nếu có)
         mongo = _mongo()
-        col = mongo.db[current_app.config.get("COLLECTION_NAME", "products")]
         emb_col = mongo.db[current_app.config.get("EMBEDDINGS_COLLECTION", "product_embeddings")]
 
+        # Map id từ VS vào Mongo 1 lần cho cả tập neighbor (_id ObjectId / _id string / field 'id'),
+        # chạy song song với query snippet (datapoint id của VS chính là product_id trong emb_col)
+        ids = [str(nid) for nid, _ in neighbors]
+        products_future = _LOOKUP_POOL.submit(
+            mongo.get_products_by_any_ids, ids, current_app.config.get("COLLECTION_NAME", "products")
+        )
+        snippets = {
+            doc["product_id"]: doc.get("text")
+            for doc in emb_col.find({"product_id": {"$in": ids}}, {"product_id": 1, "text": 1, "_id": 0})
+        }
+        products = products_future.result()
+
         results = []
         for nid, dist in neighbors:
-            product = _get_product_by_any_id(col, str(nid))
+            product = products.get(str(nid))
             if not product:
                 continue
 
@@ -84,8 +90,7 @@ def semantic_search():
             # Chuẩn hoá _id về string
             if "_id" in product:
                 product["_id"] = str(product["_id"])
-                emb_doc = emb_col.find_one({"product_id": str(product["_id"])}, {"text": 1})
-                raw_text = (emb_doc or {}).get("text") or f"{product.get('name','')}. {product.get('description','')}"
+                raw_text = snippets.get(str(nid)) or f"{product.get('name','')}. {product.get('description','')}"
                 snippet = (raw_text[:400] + "…") if len(raw_text) > 400 else raw_text
                 results.append({
                 "product": product,
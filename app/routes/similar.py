@@ -4,17 +4,26 @@ from bson import ObjectId
 
 similar_bp = Blueprint("similar_bp", __name__)
 
+# Service singletons, gán một lần khi blueprint được register
+_VERTEX = None
+_MONGO = None
+
+
+@similar_bp.record_once
+def _bind_services(state):
+    global _VERTEX, _MONGO
+    _VERTEX = state.app.config.get("VERTEX_AI_SERVICE")
+    _MONGO = state.app.config.get("MONGODB_SERVICE")
+
 def _vs():
-    svc = current_app.config.get("VERTEX_AI_SERVICE")
-    if not svc:
+    if not _VERTEX:
         raise RuntimeError("VERTEX_AI_SERVICE chưa được khởi tạo")
-    return svc
+    return _VERTEX
 
 def _mongo():
-    svc = current_app.config.get("MONGODB_SERVICE")
-    if not svc:
+    if not _MONGO:
         raise RuntimeError("MONGODB_SERVICE chưa được khởi tạo")
-    return svc
+    return _MONGO
 
 def _get_product_by_any_id(col, pid: str):
     """Tìm product theo nhiều khả năng id."""
@@ -41,13 +50,17 @@ def find_similar_products(product_id):
         if not product:
             return jsonify({"error": "Product not found"}), 404
 
-        # Text để embedding
-        name = product.get("name", "")
-        desc = product.get("description", "")
-        text = product.get("text_indexed", f"{name}. {desc}")
-
-        # Tạo embedding và tìm hàng xóm
-        emb = _vs().create_embedding(text, task_type="RETRIEVAL_DOCUMENT")
+        # Dùng embedding đã lưu khi rebuild-index (không gọi Vertex), chưa có mới tạo mới
+        emb_doc = mongo.db["product_embeddings"].find_one(
+            {"product_id": str(product["_id"])}, {"embedding": 1, "_id": 0}
+        )
+        emb = (emb_doc or {}).get("embedding")
+        if not emb:
+            # Text để embedding
+            name = product.get("name", "")
+            desc = product.get("description", "")
+            text = product.get("text_indexed", f"{name}. {desc}")
+            emb = _vs().create_embedding(text, task_type="RETRIEVAL_DOCUMENT")
         if not emb:
             return jsonify({"error": "Failed to create embedding"}), 500
 
@@ -56,11 +69,12 @@ def find_similar_products(product_id):
         # Build kết quả, bỏ chính nó
         self_id = str(product.get("_id") or product.get("id") or product_id)
         results = []
+        neighbor_products = mongo.get_products_by_any_ids([str(nid) for nid, _ in neighbors], col.name)
         for nid, dist in neighbors:
             nid = str(nid)
             if nid == self_id:
                 continue
-            sp = _get_product_by_any_id(col, nid)
+            sp = neighbor_products.get(nid)
             if not sp:
                 continue
             sp["_id"] = str(sp.get("_id", nid))
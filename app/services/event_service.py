@@ -3,9 +3,12 @@ import logging
 from datetime import datetime
 from typing import List, Dict, Optional, Any
 from bson import ObjectId
+from pymongo.errors import BulkWriteError
 
 logger = logging.getLogger(__name__)
 
+VALID_EVENT_TYPES = ("view", "cart", "purchase", "wishlist")
+
 class EventService:
     """Service quản lý events tracking (view, cart, purchase, wishlist)"""
     
@@ -37,6 +40,9 @@ class EventService:
             # Index cho timestamp để sort
             self.collection.create_index([("ts", -1)])
             
+            # Compound index cho event mới nhất của user (ETag stats)
+            self.collection.create_index([("userId", 1), ("ts", -1)])
+            
             logger.info("✓ Event indexes created")
         except Exception as e:
             logger.warning(f"Failed to create indexes: {e}")
@@ -61,9 +67,8 @@ class EventService:
             Dict chứa thông tin event đã tạo
         """
         # Validate event_type
-        valid_types = ["view", "cart", "purchase", "wishlist"]
-        if event_type not in valid_types:
-            raise ValueError(f"event_type phải là một trong: {valid_types}")
+        if event_type not in VALID_EVENT_TYPES:
+            raise ValueError(f"event_type phải là một trong: {list(VALID_EVENT_TYPES)}")
         
         # Tạo event document
         event = {
@@ -98,6 +103,8 @@ class EventService:
         failed_count = 0
         errors = []
         
+        # Cả batch dùng chung 1 timestamp, insert bằng 1 round-trip duy nhất
+        now = datetime.utcnow()
         documents = []
         for idx, event_data in enumerate(events):
             try:
@@ -110,15 +117,14 @@ class EventService:
                     raise ValueError("Missing required fields")
                 
                 # Validate type
-                valid_types = ["view", "cart", "purchase", "wishlist"]
-                if event_type not in valid_types:
+                if event_type not in VALID_EVENT_TYPES:
                     raise ValueError(f"Invalid event type: {event_type}")
                 
                 documents.append({
                     "userId": user_id,
                     "productId": product_id,
                     "type": event_type,
-                    "ts": datetime.utcnow(),
+                    "ts": now,
                     "metadata": metadata
                 })
                 
@@ -131,6 +137,12 @@ class EventService:
             try:
                 result = self.collection.insert_many(documents, ordered=False)
                 success_count = len(result.inserted_ids)
+            except BulkWriteError as e:
+                # ordered=False: các document hợp lệ vẫn được ghi
+                success_count = e.details.get("nInserted", 0)
+                failed_count += len(documents) - success_count
+                errors.append(f"Batch insert error: {e.details.get('writeErrors', [])[:5]}")
+                logger.error(f"Batch insert partially failed: {e}")
             except Exception as e:
                 logger.error(f"Batch insert failed: {e}")
                 failed_count += len(documents)
@@ -218,6 +230,23 @@ class EventService:
         
         return stats
     
+    def get_user_latest_event_ts(self, user_id: str) -> Optional[datetime]:
+        """
+        Lấy timestamp event mới nhất của user (index userId + ts desc)
+        
+        Args:
+            user_id: ID của user
+            
+        Returns:
+            Timestamp mới nhất, None nếu user chưa có event
+        """
+        doc = self.collection.find_one(
+            {"userId": user_id},
+            {"ts": 1, "_id": 0},
+            sort=[("ts", -1)]
+        )
+        return doc.get("ts") if doc else None
+    
     def get_product_events(
         self, 
         product_id: str, 
@@ -7,16 +7,17 @@ from datetime import datetime
 logger = logging.getLogger(__name__)
 
 class MongoDBService:
-    def __init__(self, uri: str, database_name: str = "product_db"):
+    def __init__(self, uri: str, database_name: str = "product_db", **client_options):
         """
         Khởi tạo MongoDB connection
         
         Args:
             uri: MongoDB connection string
             database_name: Tên database
+            client_options: Tuỳ chọn truyền thẳng cho MongoClient (minPoolSize, maxPoolSize, ...)
         """
         try:
-            self.client = MongoClient(uri)
+            self.client = MongoClient(uri, **client_options)
             self.db = self.client[database_name]
 
             # Test connection
@@ -26,10 +27,73 @@ class MongoDBService:
             # Cache tên danh mục để giảm truy vấn lặp
             self._category_cache: Dict[str, Optional[str]] = {}
 
+            self._ensure_indexes()
+
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB: {e}")
             raise
 
+    def _ensure_indexes(self):
+        """Tạo indexes cho các collection embeddings"""
+        try:
+            # Mỗi product chỉ có 1 embedding -> upsert theo product_id khi rebuild
+            self.db["product_embeddings"].create_index("product_id", unique=True)
+            self.ensure_image_embedding_indexes()
+            logger.info("✓ Embedding indexes created")
+        except Exception as e:
+            logger.warning(f"Failed to create indexes: {e}")
+
+    def ensure_image_embedding_indexes(self):
+        """
+        Indexes của product_image_embeddings (chỉ create_index, không sửa dữ liệu; gọi lúc khởi động).
+
+        Mỗi index tạo riêng: index unique lỗi (còn doc trùng datapoint_id) không kéo theo
+        index (product_id, position). Doc trùng được dọn ở migrate_image_datapoint_index().
+        """
+        col = self.db["product_image_embeddings"]
+        # Rerank multi-image: lấy ảnh theo product_id, sort theo position
+        try:
+            col.create_index([("product_id", 1), ("position", 1)])
+        except Exception as e:
+            logger.warning("Failed to create product_id/position index: %s", e)
+
+        # Tra metadata ảnh theo datapoint_id ($in từ kết quả ANN), mỗi datapoint chỉ 1 doc
+        try:
+            col.create_index("datapoint_id", unique=True)
+        except Exception as e:
+            logger.warning("Failed to create unique datapoint_id index (run an image rebuild to dedupe): %s", e)
+
+    def migrate_image_datapoint_index(self):
+        """
+        Migration xoá dữ liệu: dọn doc trùng datapoint_id rồi tạo index unique.
+
+        Chỉ gọi từ rebuild ảnh (đang giữ job lock rebuild_jobs), không chạy lúc khởi động.
+        Đã có index unique thì bỏ qua.
+        """
+        col = self.db["product_image_embeddings"]
+        if col.index_information().get("datapoint_id_1", {}).get("unique"):
+            return
+        removed = self._dedupe_image_datapoints(col)
+        if removed:
+            logger.info("Removed %d duplicate image datapoint docs", removed)
+        # Index datapoint_id cũ không unique -> cùng tên, phải drop trước khi tạo lại
+        if "datapoint_id_1" in col.index_information():
+            col.drop_index("datapoint_id_1")
+        col.create_index("datapoint_id", unique=True)
+
+    @staticmethod
+    def _dedupe_image_datapoints(col) -> int:
+        """Xoá doc trùng datapoint_id, giữ doc mới nhất (updated_at, created_at, _id)"""
+        pipeline = [
+            {"$sort": {"updated_at": -1, "created_at": -1, "_id": -1}},
+            {"$group": {"_id": "$datapoint_id", "keep": {"$first": "$_id"}, "n": {"$sum": 1}}},
+            {"$match": {"n": {"$gt": 1}}},
+        ]
+        removed = 0
+        for dup in col.aggregate(pipeline, allowDiskUse=True):
+            removed += col.delete_many({"datapoint_id": dup["_id"], "_id": {"$ne": dup["keep"]}}).deleted_count
+        return removed
+
     def get_category_name_by_id(self, category_id: str) -> Optional[str]:
         """
         Trả về tên danh mục theo id.
@@ -144,6 +208,28 @@ class MongoDBService:
             logger.error(f"Error fetching product {product_id}: {e}")
             raise
 
+    def get_products_by_any_ids(self, ids: List[str], collection_name: str = "products") -> Dict[str, Dict]:
+        """
+        Lấy nhiều product 1 lần, trả về {id: product} (doc giữ nguyên, chưa convert _id)
+        Hỗ trợ _id ObjectId / _id string (chung 1 query $in) và field 'id' (query $in thứ 2,
+        chỉ cho id còn thiếu) - thay cho vòng lặp find_one theo từng id
+        """
+        ids = [str(i) for i in ids]
+        if not ids:
+            return {}
+        collection = self.db[collection_name]
+        found: Dict[str, Dict] = {}
+
+        oids = [ObjectId(i) for i in ids if ObjectId.is_valid(i)]
+        for doc in collection.find({"_id": {"$in": oids + ids}}):
+            found[str(doc["_id"])] = doc
+
+        missing = [i for i in ids if i not in found]
+        if missing:
+            for doc in collection.find({"id": {"$in": missing}}):
+                found.setdefault(str(doc.get("id")), doc)
+        return found
+
     def get_products_paginated(self, page: int = 1, page_size: int = 100, status: str = "AVAILABLE") -> Dict:
         """
         Lấy products với pagination
@@ -0,0 +1,36 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket thread-safe: chỉ sleep khi hết token, không ngủ cố định giữa các request"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        """
+        Args:
+            rate: Số token nạp lại mỗi giây
+            capacity: Số token tối đa (burst)
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float = 1.0) -> float:
+        """
+        Lấy n token, sleep phần còn thiếu nếu bucket đang cạn
+
+        Returns:
+            Số giây đã chờ
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
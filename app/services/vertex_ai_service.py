@@ -1,8 +1,14 @@
 # services/vertex_ai_service.py
 import logging, time, random
+from functools import lru_cache
 from typing import List, Tuple, Iterable, Optional
-from google.api_core.exceptions import ResourceExhausted
+from google.api_core.exceptions import (
+    ResourceExhausted, InvalidArgument, ServiceUnavailable, InternalServerError, DeadlineExceeded
+)
 import base64
+import requests
+import google.auth
+import numpy as np
 
 from google.cloud import aiplatform
 import vertexai
@@ -11,6 +17,9 @@ from vertexai.vision_models import MultiModalEmbeddingModel, Image  # ← Thêm
 
 logger = logging.getLogger(__name__)
 
+# Lỗi tạm thời đáng retry: 429 quota + 5xx / timeout phía Vertex
+_RETRYABLE = (ResourceExhausted, ServiceUnavailable, InternalServerError, DeadlineExceeded)
+
 class VertexAIService:
     def __init__(
         self,
@@ -24,17 +33,30 @@ class VertexAIService:
         image_index_id: Optional[str] = None,
         model_name: str = "gemini-embedding-001",
         image_model_name: str = "multimodalembedding@001",  # ← Image model
+        embedding_cache_size: int = 256,
+        image_batch_predict: bool = False,
     ):
-        aiplatform.init(project=project_id, location=location)
-        vertexai.init(project=project_id, location=location)
+        # Resolve ADC credentials 1 lần, dùng chung cho mọi client (SDK tự refresh khi gần hết hạn)
+        self.credentials, _ = google.auth.default(
+            scopes=["https://www.googleapis.com/auth/cloud-platform"]
+        )
+        aiplatform.init(project=project_id, location=location, credentials=self.credentials)
+        vertexai.init(project=project_id, location=location, credentials=self.credentials)
+
+        # HTTP session dùng lại kết nối khi tải ảnh từ URL
+        self._http = requests.Session()
 
         # Text embedding
         self.embedding_model = TextEmbeddingModel.from_pretrained(model_name)
+        # LRU in-process theo text, chỉ cho RETRIEVAL_DOCUMENT (text sản phẩm lặp lại; query tự do
+        # hiếm khi trùng). Mỗi entry là np.float32 (~12 KB ở 3072 chiều), cache riêng mỗi worker
+        self._cached_embedding = lru_cache(maxsize=embedding_cache_size)(self._create_document_embedding)
         self.index_endpoint = aiplatform.MatchingEngineIndexEndpoint(index_endpoint_name=index_endpoint_id)
         self.deployed_index_id = deployed_index_id
         self.index = aiplatform.MatchingEngineIndex(index_name=index_id) if index_id else None
 
         # Image embedding ← MỚI
+        self.image_model_name = image_model_name
         self.image_embedding_model = MultiModalEmbeddingModel.from_pretrained(image_model_name)
         self.image_index_endpoint = (
             aiplatform.MatchingEngineIndexEndpoint(index_endpoint_name=image_index_endpoint_id) 
@@ -45,26 +67,41 @@ class VertexAIService:
             aiplatform.MatchingEngineIndex(index_name=image_index_id) 
             if image_index_id else None
         )
+        # Opt-in: gửi nhiều ảnh / predict qua endpoint nội bộ của SDK (_endpoint), có thể vỡ khi
+        # nâng cấp google-cloud-aiplatform. Tự tắt sau lần bị từ chối đầu tiên
+        self.image_batch_predict = image_batch_predict
 
         logger.info("✓ VertexAIService initialized (project=%s, location=%s, text_model=%s, image_model=%s)",
                     project_id, location, model_name, image_model_name)
 
     # ---------- Retry helper ----------
-    def _retry(self, fn, *, max_retries=6, base_sleep=0.6):
+    def _retry(self, fn, *, max_retries=6, base_sleep=0.6, max_sleep=30.0, jitter=0.5):
+        """Exponential backoff + jitter, chỉ sleep khi gặp lỗi tạm thời (happy path không chờ)"""
         for i in range(max_retries):
             try:
                 return fn()
-            except ResourceExhausted as e:
-                sleep = base_sleep * (2 ** i) + random.uniform(0, 0.25)
-                logger.warning("429 quota; retry %d in %.2fs: %s", i+1, sleep, e)
+            except _RETRYABLE as e:
+                sleep = min(max_sleep, base_sleep * (2 ** i)) * (1 + random.uniform(0, jitter))
+                logger.warning("%s; retry %d in %.2fs: %s", type(e).__name__, i+1, sleep, e)
                 time.sleep(sleep)
         return fn()
 
     # ---------- Text Embeddings (giữ nguyên) ----------
-    def create_embedding(self, text: str, task_type: str = "RETRIEVAL_DOCUMENT") -> List[float]:
+    def _embed_text(self, text: str, task_type: str) -> List[float]:
         inp = TextEmbeddingInput(text=text, task_type=task_type)
         return self._retry(lambda: self.embedding_model.get_embeddings([inp])[0].values)
 
+    def _create_document_embedding(self, text: str) -> np.ndarray:
+        vec = np.asarray(self._embed_text(text, "RETRIEVAL_DOCUMENT"), dtype=np.float32)
+        vec.flags.writeable = False  # entry dùng chung trong cache
+        return vec
+
+    def create_embedding(self, text: str, task_type: str = "RETRIEVAL_DOCUMENT") -> List[float]:
+        if task_type != "RETRIEVAL_DOCUMENT":
+            return self._embed_text(text, task_type)
+        # cache giữ float32 read-only, trả về list mới cho caller
+        return self._cached_embedding(text).tolist()
+
     def create_embeddings_batch(
         self, texts: Iterable[str], task_type: str = "RETRIEVAL_DOCUMENT"
     ) -> List[List[float]]:
@@ -84,9 +121,7 @@ class VertexAIService:
             image = Image.load_from_file(image_url) if image_url.startswith("gs://") else None
             if not image:
                 # Nếu là HTTP URL, download về
-                import requests
-                from io import BytesIO
-                resp = requests.get(image_url, timeout=10)
+                resp = self._http.get(image_url, timeout=10)
                 resp.raise_for_status()
                 image = Image(image_bytes=resp.content)
             
@@ -118,6 +153,59 @@ class VertexAIService:
             logger.error(f"Failed to create image embedding from bytes: {e}")
             raise
 
+    def _predict_image_batch(self, images: List[bytes], acquire) -> Optional[List[List[float]]]:
+        """
+        Gọi thẳng endpoint predict với nhiều instance (SDK chưa có API public cho việc này).
+
+        Trả về None nếu model không còn _endpoint (SDK đổi nội bộ) hoặc số prediction
+        khác số ảnh -> caller fallback về get_embeddings public từng ảnh.
+        """
+        endpoint = getattr(self.image_embedding_model, "_endpoint", None)
+        if endpoint is None or not callable(getattr(endpoint, "predict", None)):
+            logger.warning("Image embedding model has no predict endpoint, multi-instance predict disabled")
+            return None
+        acquire(1)  # nhiều ảnh / 1 predict request = 1 đơn vị quota
+
+        instances = [
+            {"image": {"bytesBase64Encoded": base64.b64encode(b).decode("ascii")}}
+            for b in images
+        ]
+        resp = self._retry(lambda: endpoint.predict(instances=instances))
+        predictions = list(resp.predictions or [])
+        if len(predictions) != len(images):
+            logger.warning(
+                "Multi-instance image predict returned %d predictions for %d images",
+                len(predictions), len(images)
+            )
+            return None
+        return [p.get("imageEmbedding") or [] for p in predictions]
+
+    def create_image_embeddings_from_bytes_batch(self, images: List[bytes], acquire=None) -> List[List[float]]:
+        """
+        Tạo embeddings cho nhiều ảnh, 1 predict request nếu bật image_batch_predict
+
+        Nếu endpoint từ chối multi-instance hoặc trả về thiếu/thừa prediction, ghi nhớ
+        và fallback gọi từng ảnh. Kết quả luôn có đúng len(images) phần tử, theo thứ tự.
+
+        acquire(n): lấy n đơn vị quota trước MỖI lời gọi Vertex (vd. TokenBucket.acquire),
+        kể cả các lời gọi từng ảnh khi fallback.
+        """
+        acquire = acquire or (lambda n: None)
+        if self.image_batch_predict and len(images) > 1:
+            try:
+                embeddings = self._predict_image_batch(images, acquire)
+            except InvalidArgument as e:
+                logger.warning("Multi-instance image predict rejected, falling back to single calls: %s", e)
+                embeddings = None
+            if embeddings is not None:
+                return embeddings
+            self.image_batch_predict = False
+        embeddings = []
+        for b in images:
+            acquire(1)
+            embeddings.append(self.create_image_embedding_from_bytes(b))
+        return embeddings
+
     def create_image_embeddings_batch(
         self, 
         image_sources: List[Tuple[str, Optional[str]]]  # [(url/path, contextual_text), ...]
@@ -148,7 +236,7 @@ class VertexAIService:
         if not self.image_index:
             raise ValueError("IMAGE_INDEX_ID is required to upsert image vectors.")
         dps = [{"datapoint_id": pid, "feature_vector": vec} for pid, vec in pairs]
-        return self.image_index.upsert_datapoints(datapoints=dps)
+        return self._retry(lambda: self.image_index.upsert_datapoints(datapoints=dps))
 
     def remove_image_vectors(self, ids: Iterable[str]):
         if not self.image_index:
@@ -217,7 +305,7 @@ class VertexAIService:
         if not self.index:
             raise ValueError("INDEX_ID is required to upsert vectors.")
         dps = [{"datapoint_id": pid, "feature_vector": vec} for pid, vec in pairs]
-        return self.index.upsert_datapoints(datapoints=dps)
+        return self._retry(lambda: self.index.upsert_datapoints(datapoints=dps))
 
     def remove_vectors(self, ids: Iterable[str]):
         if not self.index: